@@ -0,0 +1,50 @@
+import json
+import webapp2
+from channels import Channels
+from profiling import Traces
+from stats import Stats
+
+class TestHandler(webapp2.RequestHandler):
+  def get(self):
+    pass
+
+# GET /stats
+# Returns the counters and latency histograms of all instances, and the
+# channel cache statistics of the instance serving the request. POST with
+# reset=1 clears the counters.
+class StatsHandler(webapp2.RequestHandler):
+  def get(self):
+    Stats.Flush(force=True)
+    result = Stats.GetAll()
+    result['channelCache'] = Channels.CacheStats()
+    self.response.status = 200
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps(result, indent=2, sort_keys=True))
+
+  def post(self):
+    if self.request.get('reset') == '1':
+      Stats.Reset()
+    self.response.status = 204
+
+# GET /traces
+# Lists the stored request traces, newest first. With id=<trace id>, returns
+# the trace as a JSON download. See profiling.py.
+class TracesHandler(webapp2.RequestHandler):
+  def get(self):
+    self.response.headers['Content-Type'] = 'application/json'
+    traceId = self.request.get('id')
+    if not traceId:
+      self.response.status = 200
+      self.response.write(json.dumps({'traces': Traces.List()}, indent=2))
+      return
+    try:
+      trace = Traces.Get(int(traceId))
+    except ValueError:
+      trace = None
+    if trace is None:
+      self.response.status = 404
+      return
+    self.response.status = 200
+    self.response.headers['Content-Disposition'] = (
+        'attachment; filename="trace-%s.json"' % traceId)
+    self.response.write(trace)
@@ -1,90 +1,665 @@
+import hashlib
+import random
+import threading
+import time
 from datetime import datetime
 import models
+from google.appengine.api import datastore_errors, memcache
+from google.appengine.datastore import entity_pb
 from google.appengine.ext import ndb
+from lru_cache import LruCache
+from outbox import Outbox
+from stats import Stats
+import storage
+
+# Channels are cached in instance memory for a short time only, since other
+# instances can't invalidate it. Memcache is only filled by reads, with add;
+# writes delete the memcache copy and keep reads that started before the write
+# from adding the old value for _WRITE_LOCK_SECONDS.
+_LOCAL_CACHE_SIZE = 10000
+_LOCAL_CACHE_TTL = 10
+_MEMCACHE_PREFIX = 'RelayChannel/'
+_MEMCACHE_TTL = 60 * 60
+_WRITE_LOCK_SECONDS = 5
+
+# Channels that were removed, so that notifications for them are dropped
+# without a datastore lookup. Drive keeps sending notifications for removed
+# channels until the watch expires, which is at most the requested channel TTL
+# after it's created. A channel that merely isn't found isn't marked, since
+# it may still be about to be stored.
+_DEAD_PREFIX = 'DeadChannel/'
+_DEAD_TTL = 3 * 60 * 60
+
+# Sync notifications for channels that aren't stored yet are remembered this
+# long for Add().
+_EARLY_SYNC_PREFIX = 'EarlySync/'
+_EARLY_SYNC_TTL = 5 * 60
+# State transitions are retried this many times when transactions collide.
+_TRANSACTION_ATTEMPTS = 5
+_TRANSACTION_BACKOFF = 0.05
+
+# Upper bound of channels sharing one Drive watch.
+_MAX_SUBSCRIBERS = 20
+
+# Expired channels are deleted in batches of this size.
+_CLEANUP_BATCH_SIZE = 500
+_CLEANUP_PARALLEL_BATCHES = 4
+
+_cache = LruCache(_LOCAL_CACHE_SIZE, _LOCAL_CACHE_TTL)
+_deadCache = LruCache(_LOCAL_CACHE_SIZE, _LOCAL_CACHE_TTL)
+_statsLock = threading.Lock()
+_stats = {'memcacheHits': 0, 'memcacheMisses': 0}
 
 class Channels(object):
   @staticmethod
-  def Add(driveChannelId, token, gcmChannelId, expiration, largestChangeId):
+  def _Serialize(channel):
+    return ndb.model_to_protobuf(channel).SerializeToString()
+
+  @staticmethod
+  def _Deserialize(serialized):
+    return ndb.model_from_protobuf(entity_pb.EntityProto(serialized))
+
+  @staticmethod
+  def _CountMemcache(hits, misses):
+    with _statsLock:
+      _stats['memcacheHits'] += hits
+      _stats['memcacheMisses'] += misses
+
+  @staticmethod
+  def _Load(driveChannelId):
+    return Channels._LoadMulti([driveChannelId])[0]
+
+  @staticmethod
+  def _LoadMulti(driveChannelIds):
+    # Reads through the instance cache and memcache, with one batch call per
+    # tier. Each call returns new entities so that callers are free to modify
+    # them. Channels known to be dead are never looked up in the datastore.
+    serialized = [_cache.Get(channelId) for channelId in driveChannelIds]
+    missing = [index for index, value in enumerate(serialized)
+               if value is None and not Channels.IsDead(driveChannelIds[index])]
+    if missing:
+      ids = [driveChannelIds[index] for index in missing]
+      cached = memcache.get_multi([_MEMCACHE_PREFIX + channelId
+                                   for channelId in ids] +
+                                  [_DEAD_PREFIX + channelId
+                                   for channelId in ids])
+      fetch = []
+      for index, channelId in zip(missing, ids):
+        serialized[index] = cached.get(_MEMCACHE_PREFIX + channelId)
+        if _DEAD_PREFIX + channelId in cached:
+          _deadCache.Set(channelId, True)
+        elif serialized[index] is None:
+          fetch.append(index)
+      Channels._CountMemcache(len(missing) - len(fetch), len(fetch))
+      if fetch:
+        channels = storage.GetBackend().GetMulti(models.RelayChannel,
+            [driveChannelIds[index] for index in fetch])
+        fetched = {}
+        for index, channel in zip(fetch, channels):
+          if channel is not None:
+            serialized[index] = Channels._Serialize(channel)
+            fetched[driveChannelIds[index]] = serialized[index]
+        if fetched:
+          memcache.add_multi(fetched, key_prefix=_MEMCACHE_PREFIX,
+                             time=_MEMCACHE_TTL)
+      for index in missing:
+        if serialized[index] is not None:
+          _cache.Set(driveChannelIds[index], serialized[index])
+    return [None if value is None else Channels._Deserialize(value)
+            for value in serialized]
+
+  @staticmethod
+  def _Put(channel):
+    storage.GetBackend().PutMulti([channel])
+    Channels._Cache(channel)
+
+  @staticmethod
+  def _Cache(channel):
+    # Called after |channel| is written. Only this instance keeps the new
+    # value; the next read of another instance fills memcache.
+    driveChannelId = channel.key.id()
+    memcache.delete(_MEMCACHE_PREFIX + driveChannelId,
+                    seconds=_WRITE_LOCK_SECONDS)
+    _cache.Set(driveChannelId, Channels._Serialize(channel))
+
+  @staticmethod
+  def _Invalidate(driveChannelIds):
+    _cache.DeleteMulti(driveChannelIds)
+    memcache.delete_multi(driveChannelIds, seconds=_WRITE_LOCK_SECONDS,
+                          key_prefix=_MEMCACHE_PREFIX)
+
+  @staticmethod
+  def IsDead(driveChannelId):
+    # Only consults instance memory, so it's cheap enough to check before any
+    # other work on a notification.
+    return _deadCache.Get(driveChannelId) is not None
+
+  @staticmethod
+  def _MarkDead(driveChannelIds):
+    for channelId in driveChannelIds:
+      _deadCache.Set(channelId, True)
+    memcache.set_multi(dict.fromkeys(driveChannelIds, True),
+                       key_prefix=_DEAD_PREFIX, time=_DEAD_TTL)
+
+  @staticmethod
+  def _Revive(driveChannelIds):
+    # Other instances may keep treating the channels as dead until their
+    # instance cache expires.
+    _deadCache.DeleteMulti(driveChannelIds)
+    memcache.delete_multi(driveChannelIds, key_prefix=_DEAD_PREFIX)
+
+  @staticmethod
+  def CacheStats():
+    stats = _cache.Stats()
+    with _statsLock:
+      stats.update(_stats)
+    return stats
+
+  @staticmethod
+  def _EarlySyncKey(driveChannelId, token):
+    return '%s%s/%s' % (_EARLY_SYNC_PREFIX, driveChannelId,
+                        hashlib.sha1(token).hexdigest())
+
+  @staticmethod
+  def _InitialState(largestChangeId, synced, gcmChannelId, previousChannelId):
+    # Returns the relay state properties of a new channel. A channel that
+    # replaces |previousChannelId| of the same client keeps the changes the
+    # client hasn't acknowledged by binding with |largestChangeId|: the largest
+    # change id, whether a relayed change is still being processed, the range
+    # relayed since and the outbox. If the client has seen all changes, the
+    # channel starts out ready, like after Renew().
+    status = models.STATUS_READY if synced else models.STATUS_CREATED
+    clientChangeId = largestChangeId
+    firstChangeId = None
+    notificationCount = 0
+    outbox = None
+    previous = None
+    if previousChannelId is not None:
+      previous = Channels._Get(previousChannelId)
+    if previous is not None and previous.gcmChannelId == gcmChannelId:
+      previousChangeId = previous.changeIdAndStatus >> models.CHANGE_ID_SHIFT
+      if previousChangeId > largestChangeId:
+        firstChangeId = largestChangeId + 1
+        largestChangeId = previousChangeId
+        notificationCount = previous.notificationCount or 0
+        if (previous.changeIdAndStatus & models.STATUS_MASK ==
+            models.STATUS_PENDING):
+          status = models.STATUS_PENDING
+      outbox = Outbox.Trim(previous.outbox, clientChangeId)
+    return {
+      'changeIdAndStatus': (largestChangeId << models.CHANGE_ID_SHIFT) | status,
+      'firstChangeId': firstChangeId,
+      'notificationCount': notificationCount,
+      'outbox': outbox,
+    }
+
+  @staticmethod
+  def Add(driveChannelId, token, gcmChannelId, expiration, largestChangeId,
+          accountId=None, previousChannelId=None):
+    # Returns True if the sync notification for the channel has already
+    # arrived, in which case the channel is stored as ready. If |accountId| is
+    # given, later channels of the account will share the watch of this one.
+    earlySyncKey = Channels._EarlySyncKey(driveChannelId, token)
+    synced = memcache.get(earlySyncKey)
     channel = models.RelayChannel(
         key=ndb.Key(models.RelayChannel, driveChannelId),
         gcmChannelId = gcmChannelId,
-        token = token,
+        tokenHash = models.HashToken(token),
         expiration = expiration,
-        changeIdAndStatus = ((largestChangeId << models.CHANGE_ID_SHIFT) |
-                                                 models.STATUS_CREATED))
-    channel.put()
+        **Channels._InitialState(largestChangeId, synced, gcmChannelId,
+                                 previousChannelId))
+    Channels._Revive([driveChannelId])
+    if accountId is None:
+      Channels._Put(channel)
+    else:
+      storage.GetBackend().PutMulti([channel, models.AccountWatch(
+          key=ndb.Key(models.AccountWatch, accountId),
+          channelId=driveChannelId,
+          expiration=expiration)])
+      Channels._Cache(channel)
+    if not synced and memcache.get(earlySyncKey):
+      # The sync notification arrived while the channel was being stored, and
+      # may have missed it.
+      Channels._Transition(driveChannelId, None, Channels._SyncTransition,
+                           None)
+      synced = True
+    return bool(synced)
 
   @staticmethod
-  def _Get(driveChannelId, tokenToVerify=None):
-    channel = ndb.Key(models.RelayChannel, driveChannelId).get()
-    if channel is None:
+  def Attach(accountId, driveChannelId, gcmChannelId, largestChangeId,
+             minExpiration, previousChannelId=None):
+    # Adds a channel that shares the Drive watch of the account, if it has one
+    # that lasts until |minExpiration|. Returns (expiration, synced) for the
+    # new channel, or None if a new watch is needed. A channel never replaces
+    # |previousChannelId| with a channel of the same watch.
+    backend = storage.GetBackend()
+    watch = backend.Get(models.AccountWatch, accountId)
+    if (watch is None or watch.expiration < minExpiration or
+        watch.channelId == previousChannelId):
       return None
-    if tokenToVerify is not None and channel.token != tokenToVerify:
+    Channels._Revive([driveChannelId])
+    state = Channels._InitialState(largestChangeId, True, gcmChannelId,
+                                   previousChannelId)
+
+    def Txn():
+      owner = backend.Get(models.RelayChannel, watch.channelId)
+      if (owner is None or owner.expiration < minExpiration or
+          len(owner.subscriberIds) >= _MAX_SUBSCRIBERS or
+          previousChannelId in owner.subscriberIds):
+        return None
+      owner.subscriberIds.append(driveChannelId)
+      channelState = dict(state)
+      synced = (owner.changeIdAndStatus & models.STATUS_MASK !=
+                models.STATUS_CREATED)
+      if not synced and (state['changeIdAndStatus'] & models.STATUS_MASK ==
+                         models.STATUS_READY):
+        channelState['changeIdAndStatus'] = (state['changeIdAndStatus'] &
+            ~models.STATUS_MASK | models.STATUS_CREATED)
+      channel = models.RelayChannel(
+          key=ndb.Key(models.RelayChannel, driveChannelId),
+          gcmChannelId = gcmChannelId,
+          watchId = watch.channelId,
+          expiration = owner.expiration,
+          **channelState)
+      backend.PutMulti([owner, channel])
+      return (owner, channel, synced)
+
+    result = Channels._RunInTransaction(Txn, xg=True)
+    if result is None:
       return None
-    return channel
+    owner, channel, synced = result
+    Channels._Cache(owner)
+    Channels._Cache(channel)
+    return (channel.expiration, synced)
 
   @staticmethod
-  def UpdateExpiration(driveChannelId, expiration):
+  def Retire(driveChannelId, gcmChannelId):
+    # Called once the channel replacing |driveChannelId| is stored, so that
+    # the client of |gcmChannelId| isn't notified twice. A channel sharing
+    # another channel's watch is detached from it and removed, as is a channel
+    # whose watch isn't shared. Drive keeps sending notifications for its
+    # watch, which are dropped. A channel whose watch is still shared keeps
+    # relaying to the subscribers but no longer notifies its own client.
     channel = Channels._Get(driveChannelId)
+    if channel is None or channel.gcmChannelId != gcmChannelId:
+      return
+
+    def Txn():
+      backend = storage.GetBackend()
+      channel = backend.Get(models.RelayChannel, driveChannelId)
+      if channel is None or channel.gcmChannelId != gcmChannelId:
+        return (channel, [])
+      if channel.subscriberIds:
+        channel.gcmChannelId = None
+        backend.PutMulti([channel])
+        return (channel, [])
+      updated = []
+      if channel.watchId is not None:
+        owner = backend.Get(models.RelayChannel, channel.watchId)
+        if owner is not None and driveChannelId in owner.subscriberIds:
+          owner.subscriberIds.remove(driveChannelId)
+          updated.append(owner)
+      backend.PutMulti(updated)
+      backend.DeleteMulti(models.RelayChannel, [driveChannelId])
+      return (None, updated)
+
+    channel, updated = Channels._RunInTransaction(
+        Txn, xg=channel.watchId is not None)
+    for owner in updated:
+      Channels._Cache(owner)
+    if channel is not None:
+      Channels._Cache(channel)
+    else:
+      Channels._Invalidate([driveChannelId])
+      Channels._MarkDead([driveChannelId])
+
+  @staticmethod
+  def _Get(driveChannelId, tokenHash=None):
+    channel = Channels._Load(driveChannelId)
     if channel is None:
-      return False
-    channel.expiration = expiration
-    channel.put()
-    return True
+      return None
+    if tokenHash is not None and not channel.VerifyTokenHash(tokenHash):
+      return None
+    return channel
 
   @staticmethod
-  def Sync(driveChannelId, token):
-    channel = Channels._Get(driveChannelId, token)
+  def VerifyToken(driveChannelId, tokenHash):
+    # Returns whether the channel exists and has the token with |tokenHash|.
+    # Reads through the caches.
+    return Channels._Get(driveChannelId, tokenHash) is not None
+
+  @staticmethod
+  def _RunInTransaction(callback, **options):
+    # Retries contended transactions with jittered exponential backoff.
+    for attempt in xrange(_TRANSACTION_ATTEMPTS):
+      try:
+        return storage.GetBackend().RunInTransaction(callback, **options)
+      except datastore_errors.TransactionFailedError:
+        if attempt + 1 == _TRANSACTION_ATTEMPTS:
+          raise
+        time.sleep(random.uniform(0, _TRANSACTION_BACKOFF * 2 ** attempt))
+
+  @staticmethod
+  def _Transition(driveChannelId, tokenHash, transition, missing,
+                  monotonic=False):
+    # Applies |transition| to the channel as a compare-and-set. |transition|
+    # updates the channel in place and returns (changed, result). Returns
+    # |missing| if the channel doesn't exist or the token doesn't match.
+    # |monotonic| transitions only depend on the change id of the channel.
+    channel = Channels._Get(driveChannelId, tokenHash)
     if channel is None:
-      return (False, None)
-    if channel.changeIdAndStatus & models.STATUS_MASK == models.STATUS_CREATED:
-      channel.changeIdAndStatus = (channel.changeIdAndStatus &
-          ~models.STATUS_MASK | models.STATUS_READY)
-      channel.put()
-      return (True, channel.gcmChannelId)
-    return (False, None)
+      return missing
+    changed, result = transition(channel)
+    if not changed and monotonic:
+      # Change ids never decrease, so a no-op on a cached copy is a no-op on
+      # the stored entity as well. Other fields, like the status, may go
+      # either way and are only trusted inside the transaction.
+      return result
+
+    def Txn():
+      backend = storage.GetBackend()
+      channel = backend.Get(models.RelayChannel, driveChannelId)
+      if channel is None or (tokenHash is not None and
+                             not channel.VerifyTokenHash(tokenHash)):
+        return (missing, channel)
+      changed, result = transition(channel)
+      if changed:
+        backend.PutMulti([channel])
+      return (result, channel)
+
+    result, channel = Channels._RunInTransaction(Txn)
+    if channel is None:
+      Channels._Invalidate([driveChannelId])
+    else:
+      Channels._Cache(channel)
+    return result
 
   @staticmethod
-  def UpdateChangeId(driveChannelId, token, largestChangeId):
-    channel = Channels._Get(driveChannelId, token)
+  def UpdateExpiration(driveChannelId, expiration):
+    def Transition(channel):
+      if channel.expiration == expiration:
+        return (False, True)
+      channel.expiration = expiration
+      return (True, True)
+    return Channels._Transition(driveChannelId, None, Transition, False)
+
+  @staticmethod
+  def _FanOut(driveChannelId, tokenHash, transition, monotonic=False):
+    # Applies |transition| to the channel with the Drive watch and to all
+    # channels sharing it, see _Transition(). Returns the list of
+    # (channelId, result) for the channels that still exist, or None if the
+    # channel with the watch doesn't. All channels are written in one
+    # transaction, which spans at most _MAX_SUBSCRIBERS + 1 entity groups.
+    channel = Channels._Get(driveChannelId, tokenHash)
     if channel is None:
+      return None
+    if monotonic:
+      channelIds = [driveChannelId] + channel.subscriberIds
+      channels = [channel] + Channels._LoadMulti(channel.subscriberIds)
+      results = []
+      for channelId, cached in zip(channelIds, channels):
+        if cached is None:
+          continue
+        changed, result = transition(cached)
+        if changed:
+          break
+        results.append((channelId, result))
+      else:
+        return results
+
+    def Txn():
+      backend = storage.GetBackend()
+      owner = backend.Get(models.RelayChannel, driveChannelId)
+      if owner is None or (tokenHash is not None and
+                           not owner.VerifyTokenHash(tokenHash)):
+        return (None, [driveChannelId], [None], [])
+      channelIds = [driveChannelId] + owner.subscriberIds
+      channels = [owner] + backend.GetMulti(models.RelayChannel,
+                                            owner.subscriberIds)
+      results = []
+      updated = []
+      for channelId, channel in zip(channelIds, channels):
+        if channel is None:
+          continue
+        changed, result = transition(channel)
+        results.append((channelId, result))
+        if changed:
+          updated.append(channel)
+      if updated:
+        backend.PutMulti(updated)
+      return (results, channelIds, channels, updated)
+
+    results, channelIds, channels, updated = Channels._RunInTransaction(
+        Txn, xg=True)
+    Channels._Invalidate([channelId for channelId, channel
+                          in zip(channelIds, channels) if channel is None])
+    for channel in updated:
+      Channels._Cache(channel)
+    return results
+
+  @staticmethod
+  def _SyncTransition(channel):
+    if (channel.changeIdAndStatus & models.STATUS_MASK !=
+        models.STATUS_CREATED):
       return (False, None)
-    if channel.changeIdAndStatus >> models.CHANGE_ID_SHIFT < largestChangeId:
-      result = (channel.changeIdAndStatus & models.STATUS_MASK ==
-          models.STATUS_READY)
+    channel.changeIdAndStatus = (channel.changeIdAndStatus &
+        ~models.STATUS_MASK | models.STATUS_READY)
+    return (True, channel.gcmChannelId)
+
+  @staticmethod
+  def Sync(driveChannelId, token):
+    # Returns the list of (channelId, gcmChannelId) to notify.
+    results = Channels._FanOut(driveChannelId, models.HashToken(token),
+                               Channels._SyncTransition)
+    if results is None:
+      # The bind request that creates the channel may still be waiting for
+      # the watch response. Let it know that the channel is synced.
+      memcache.set(Channels._EarlySyncKey(driveChannelId, token), True,
+                   time=_EARLY_SYNC_TTL)
+      return []
+    return [(channelId, gcmChannelId) for channelId, gcmChannelId in results
+            if gcmChannelId is not None]
+
+  @staticmethod
+  def UpdateChangeId(driveChannelId, tokenHash, largestChangeId,
+                     notifications=1):
+    # |notifications| is the number of change notifications folded into this
+    # update, see Relay. Returns the list of (channelId, gcmChannelId,
+    # firstChangeId, notificationCount) to notify, see _ChangeRange().
+    def Transition(channel):
+      # The result is the outcome for the channel and, if it's notified, its
+      # notification. Retired channels only relay to their subscribers.
+      if channel.gcmChannelId is None:
+        return (False, ('suppressed.retired', None))
+      currentChangeId = channel.changeIdAndStatus >> models.CHANGE_ID_SHIFT
+      if currentChangeId >= largestChangeId:
+        return (False, ('suppressed.stale', None))
+      status = channel.changeIdAndStatus & models.STATUS_MASK
       channel.changeIdAndStatus = (largestChangeId <<
           models.CHANGE_ID_SHIFT) | models.STATUS_PENDING
-      channel.put()
-      return (result, channel.gcmChannelId)
-    return (False, None)
+      if channel.firstChangeId is None:
+        channel.firstChangeId = currentChangeId + 1
+      channel.notificationCount = ((channel.notificationCount or 0) +
+                                   notifications)
+      channel.outbox = Outbox.Append(channel.outbox, largestChangeId)
+      if status != models.STATUS_READY:
+        return (True, ('suppressed.pending' if status == models.STATUS_PENDING
+                       else 'suppressed.unsynced', None))
+      return (True, ('relayed', (channel.gcmChannelId,) +
+                                Channels._ChangeRange(channel)))
+    results = Channels._FanOut(driveChannelId, tokenHash, Transition,
+                               monotonic=True)
+    if results is None:
+      Stats.Count('notify.unknownChannel')
+      return []
+    targets = []
+    for channelId, (outcome, notification) in results:
+      Stats.Count('notify.' + outcome)
+      if notification is not None:
+        targets.append((channelId,) + notification)
+    return targets
+
+  @staticmethod
+  def _ChangeRange(channel):
+    # Returns the first change id the client hasn't acknowledged and the
+    # number of change notifications since the client last bound.
+    firstChangeId = channel.firstChangeId
+    if firstChangeId is None:
+      firstChangeId = (channel.changeIdAndStatus >>
+                       models.CHANGE_ID_SHIFT) + 1
+    return (firstChangeId, channel.notificationCount or 0)
+
+  @staticmethod
+  def RollBack(driveChannelId, largestChangeId):
+    # Called when the notification of |largestChangeId| couldn't be
+    # delivered, so that the channel doesn't stay pending forever. Returns
+    # (gcmChannelId, largestChangeId, firstChangeId, notificationCount) if
+    # changes that were suppressed in the meantime should be relayed instead,
+    # or None. The client still hasn't acknowledged any of the changes.
+    def Transition(channel):
+      currentChangeId = channel.changeIdAndStatus >> models.CHANGE_ID_SHIFT
+      if (channel.gcmChannelId is None or
+          channel.changeIdAndStatus & models.STATUS_MASK !=
+          models.STATUS_PENDING or currentChangeId < largestChangeId):
+        return (False, None)
+      if currentChangeId > largestChangeId:
+        return (False, (channel.gcmChannelId, currentChangeId) +
+                       Channels._ChangeRange(channel))
+      channel.changeIdAndStatus = ((currentChangeId <<
+          models.CHANGE_ID_SHIFT) | models.STATUS_READY)
+      return (True, None)
+    return Channels._Transition(driveChannelId, None, Transition, None)
+
+  @staticmethod
+  def _RenewTransition(largestChangeId):
+    def Transition(channel):
+      currentChangeId = channel.changeIdAndStatus >> models.CHANGE_ID_SHIFT
+      if currentChangeId > largestChangeId:
+        return (False, currentChangeId)
+      changeIdAndStatus = ((largestChangeId << models.CHANGE_ID_SHIFT) |
+                           models.STATUS_READY)
+      outbox = Outbox.Trim(channel.outbox, largestChangeId)
+      if (channel.changeIdAndStatus == changeIdAndStatus and
+          channel.firstChangeId is None and not channel.notificationCount and
+          channel.outbox == outbox):
+        return (False, True)
+      # Binding acknowledges all changes up to |largestChangeId|.
+      channel.changeIdAndStatus = changeIdAndStatus
+      channel.firstChangeId = None
+      channel.notificationCount = 0
+      channel.outbox = outbox
+      return (True, True)
+    return Transition
 
   @staticmethod
   def Renew(driveChannelId, largestChangeId):
-    channel = Channels._Get(driveChannelId)
-    if channel is None:
-      return None
-    if channel.changeIdAndStatus >> models.CHANGE_ID_SHIFT <= largestChangeId:
-      channel.changeIdAndStatus = (largestChangeId << models.CHANGE_ID_SHIFT
-          ) | models.STATUS_READY
-      channel.put()
-      return True
-    return channel.changeIdAndStatus >> models.CHANGE_ID_SHIFT
+    return Channels._Transition(driveChannelId, None,
+        Channels._RenewTransition(largestChangeId), None)
+
+  @staticmethod
+  def RenewMulti(renewals):
+    # |renewals| is a list of (channelId, largestChangeId) for distinct
+    # channels, no more than the number of entity groups a transaction may
+    # span. Returns the result of Renew() for each of them. All changed
+    # channels are written in one transaction. Renewals reset the status, so
+    # they are never skipped based on cached copies.
+    if not renewals:
+      return []
+    transitions = [Channels._RenewTransition(largestChangeId)
+                   for _, largestChangeId in renewals]
+    channelIds = [channelId for channelId, _ in renewals]
+
+    def Txn():
+      backend = storage.GetBackend()
+      channels = backend.GetMulti(models.RelayChannel, channelIds)
+      results = []
+      updated = []
+      for transition, channel in zip(transitions, channels):
+        if channel is None:
+          results.append(None)
+          continue
+        isChanged, result = transition(channel)
+        results.append(result)
+        if isChanged:
+          updated.append(channel)
+      if updated:
+        backend.PutMulti(updated)
+      return (results, channels, updated)
+
+    results, channels, updated = Channels._RunInTransaction(
+        Txn, xg=len(channelIds) > 1)
+    Channels._Invalidate([channelId for channelId, channel
+                          in zip(channelIds, channels) if channel is None])
+    for channel in updated:
+      Channels._Cache(channel)
+    return results
 
   @staticmethod
   def GetStatus(driveChannelId):
+    return Channels.GetStatusMulti([driveChannelId])[0]
+
+  @staticmethod
+  def GetStatusMulti(driveChannelIds):
+    return [None if channel is None else
+            channel.changeIdAndStatus & models.STATUS_MASK
+            for channel in Channels._LoadMulti(driveChannelIds)]
+
+  @staticmethod
+  def GetOutbox(driveChannelId):
+    # Returns the (changeId, time) notifications the client of the channel
+    # hasn't acknowledged, and the largest change id of those that were
+    # dropped, or None if the channel doesn't exist or has expired. The watch
+    # of an expired channel no longer reports changes, so its outbox can't be
+    # trusted to be complete.
     channel = Channels._Get(driveChannelId)
-    if channel is None:
+    if channel is None or channel.expiration < datetime.now():
       return None
-    return channel.changeIdAndStatus & models.CHANGE_ID_MASK
+    return Outbox.Decode(channel.outbox)
 
   @staticmethod
   def Remove(driveChannelId):
-    ndb.Key(models.RelayChannel, driveChannelId).delete()
+    storage.GetBackend().DeleteMulti(models.RelayChannel, [driveChannelId])
+    Channels._Invalidate([driveChannelId])
+    Channels._MarkDead([driveChannelId])
+
+  @staticmethod
+  def Cleanup(cutoff, cursor=None, deadline=None):
+    # Deletes channels that expired before |cutoff| page by page, with up to
+    # _CLEANUP_PARALLEL_BATCHES deletions in flight. Stops early when
+    # time.time() passes |deadline|. Returns the number of deleted channels and
+    # a cursor string to resume from, or None if all expired channels are
+    # deleted.
+    backend = storage.GetBackend()
+    deleted = 0
+    futures = []
+    more = True
+    while more and (deadline is None or time.time() < deadline):
+      ids, cursor, more = backend.QueryByExpiration(models.RelayChannel, None,
+          cutoff, _CLEANUP_BATCH_SIZE, cursor, keysOnly=True)
+      if ids:
+        futures.append(backend.DeleteMultiAsync(models.RelayChannel, ids))
+        Channels._Invalidate(ids)
+        deleted += len(ids)
+      if len(futures) >= _CLEANUP_PARALLEL_BATCHES:
+        for future in futures.pop(0):
+          future.get_result()
+    for batch in futures:
+      for future in batch:
+        future.get_result()
+    return deleted, (cursor if more else None)
+
+  @staticmethod
+  def FindExpiring(start, end, pageSize, cursor=None):
+    # Returns a page of (channelId, gcmChannelId, expiration) for channels
+    # expiring between |start| and |end|, the cursor string of the next page
+    # and whether there are more pages. Retired channels are left out.
+    channels, cursor, more = storage.GetBackend().QueryByExpiration(
+        models.RelayChannel, start, end, pageSize, cursor)
+    return ([(channel.key.id(), channel.gcmChannelId, channel.expiration)
+             for channel in channels if channel.gcmChannelId is not None],
+            cursor, more)
 
   @staticmethod
-  def Cleanup():
-    keys = [key for key in
-        models.RelayChannel.query(models.RelayChannel.expiration <
-        datetime.now()).iter(keys_only = True, limit = 100)]
-    ndb.delete_multi(keys)
-    return len(keys)
+  def CountExpired(cutoff, limit):
+    return storage.GetBackend().CountByExpiration(models.RelayChannel, cutoff,
+                                                 limit)
@@ -0,0 +1,532 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import time
+import urllib
+import webapp2
+from datetime import datetime, timedelta
+from google.appengine.api import app_identity, memcache
+from channels import Channels
+import http_client
+from http_client import HttpClient
+import models
+from relay import Relay
+from renewal import RENEWAL_LEAD
+import validation
+
+# Requested time-to-live for channels, in seconds.
+_CHANNEL_TTL = 60 * 60 * 2
+_PROPERTY_BASE_URL = 'https://www.googleapis.com/drive/v2/files/root/properties/gcmChannel_'
+_PROPERTY_REQUEST_PARAMETER = '?visibility=PRIVATE&fields=value'
+_CHANGES_WATCH_URL = 'https://www.googleapis.com/drive/v2/changes/watch?prettyPrint=false'
+_CHANNELS_STOP_URL = 'https://www.googleapis.com/drive/v2/channels/stop'
+_DRIVE_API_WATCH_TYPE = 'web_hook'
+_ABOUT_URL = 'https://www.googleapis.com/drive/v2/about?fields=permissionId'
+# Whether channels of the same account share one Drive watch.
+_SHARE_WATCHES = True
+# New channels only share a watch that lasts at least this long. Clients are
+# asked to renew their channels up to RENEWAL_LEAD before the watch expires,
+# and the renewed channel must not share the expiring watch.
+_MIN_SHARED_WATCH_TTL = RENEWAL_LEAD + timedelta(minutes=10)
+# The permission id of the account of an access token is cached for the
+# lifetime of the token, so that later binds with the same token don't look
+# it up again.
+_ACCOUNT_ID_PREFIX = 'AccountId/'
+_ACCOUNT_ID_CACHE_TTL = 60 * 60
+# Should be consistent with ../js/push_notifications.js
+_CHANNEL_TIME_SEPARATOR = '|'
+
+_STATUS_NAMES = {
+  models.STATUS_CREATED: 'created',
+  models.STATUS_READY: 'ready',
+  models.STATUS_PENDING: 'pending',
+}
+
+# POST /bind
+# Authorization: Bearer ...
+# Content-Type: application/json
+# Origin: chrome-extension://bjajfhkjlejiflopbocmfjijlomojaof
+# User-Agent: ...
+#
+# {
+#   "channelId": ..., // Optional, used for subsequent binds. For first binds,
+#                     // the channel being replaced.
+#   "clientId": ..., // Optional, only used for the first bind.
+#   "largestChangeId": "1234", // Required. Current known largest change id.
+# }
+#
+# HTTP 200 OK
+# {
+#   "channelId": ..., // Optional, only returned for the first bind.
+#   "expiration": ..., // Optional, only returned for the first bind.
+# }
+#
+# Batch renewal of channels:
+#
+# POST /bind
+# Content-Type: application/json
+#
+# {
+#   "channels": [{"channelId": ..., "largestChangeId": "1234"}, ...]
+# }
+#
+# HTTP 200 OK
+# {
+#   // One for each channel, with the status code and body of a single bind.
+#   "results": [{"status": 204}, {"status": 200, "largestChangeId": "1240"},
+#               {"status": 404}, ...]
+# }
+class BindHandler(webapp2.RequestHandler):
+  def post(self):
+    self.response.headers['Content-Type'] = 'text/plain'
+    if len(self.request.body) > validation.MAX_BATCH_REQUEST_BODY_LEN:
+      self.response.status = 413
+      return
+
+    request = None
+    try:
+      request = json.loads(self.request.body)
+    except ValueError:
+      self.response.status = 400
+      self.response.write('Invalid JSON.')
+      return
+    if not isinstance(request, dict):
+      self.response.status = 400
+      self.response.write('Invalid JSON.')
+      return
+
+    if 'channels' in request:
+      self._refreshChannels(request.get('channels'))
+      return
+    if len(self.request.body) > validation.MAX_REQUEST_BODY_LEN:
+      self.response.status = 413
+      return
+
+    clientId, channelId, largestChangeId = (request.get(key) for key in [
+        'clientId', 'channelId', 'largestChangeId'])
+    if largestChangeId is None or not isinstance(largestChangeId, basestring):
+      self.response.status = 400
+      self.response.write('Required field missing.')
+      return
+
+    try:
+      largestChangeId = int(largestChangeId)
+    except ValueError:
+      self.response.status = 400
+      self.response.write('Invalid largest change ID.')
+      return
+
+    if clientId is not None:
+      # First bind.
+      # Authorization is required.
+      if self.request.headers.get('Authorization') is None:
+        self.response.status = 401
+        return
+
+      if validation.CLIENT_ID_REGEX.match(clientId) is None:
+        self.response.status = 400
+        self.response.write('Invalid client ID.')
+        return
+
+      # A channel that is being replaced by the same client keeps its relay
+      # state, and is retired once the new channel is stored.
+      previousChannelId = None
+      if (isinstance(channelId, basestring) and
+          validation.CHANNEL_ID_REGEX.match(channelId)):
+        previousChannelId = channelId
+      self._createChannel(clientId, largestChangeId, previousChannelId)
+
+    elif channelId is not None:
+      # Subsequent binds to resume the channel.
+      self._refreshChannel(channelId, largestChangeId)
+      
+    else:
+      self.response.status = 400
+      self.response.write('Invalid fields specified.')
+
+  def _createChannel(self, clientId, largestChangeId, previousChannelId):
+    # When watches are shared, the account is looked up together with the
+    # property, and the watch is only requested if the account doesn't have
+    # a usable one, so that channels sharing a watch cost no watch requests.
+    # Otherwise the watch request is in flight together with the property
+    # request.
+    channelId, token = self._generateChannelIdAndToken()
+    propertyRequest = self._sendGetPropertyRequest(clientId)
+    watchRequest = aboutRequest = accountId = None
+    if _SHARE_WATCHES:
+      accountId = self._getCachedAccountId()
+      if accountId is None:
+        aboutRequest = self._sendRequest('GET', _ABOUT_URL)
+    else:
+      watchRequest = self._sendWatchRequest(channelId, token)
+
+    gcmChannel = self._parseGetPropertyResponse(propertyRequest)
+    if gcmChannel is None:
+      if watchRequest is not None:
+        self._stopUnusedWatch(channelId, watchRequest)
+      return
+
+    if aboutRequest is not None:
+      accountId = self._parseAboutResponse(aboutRequest)
+    if _SHARE_WATCHES:
+      if accountId is not None:
+        attached = Channels.Attach(accountId, channelId, gcmChannel,
+            largestChangeId, datetime.now() + _MIN_SHARED_WATCH_TTL,
+            previousChannelId)
+        if attached is not None:
+          expiration, synced = attached
+          if previousChannelId is not None:
+            Channels.Retire(previousChannelId, gcmChannel)
+          if synced:
+            Relay.NotifySynced([(channelId, gcmChannel)])
+          self._writeChannel(channelId,
+              int(time.mktime(expiration.timetuple()) * 1000))
+          return
+      watchRequest = self._sendWatchRequest(channelId, token)
+
+    response = self._parseWatchResponse(watchRequest)
+    if response is None:
+      return
+    try:
+      expiration = datetime.fromtimestamp(
+          int(response.get('expiration')) / 1000.0)
+    except (ValueError, TypeError):
+      logging.warning('Drive API changes.watch\'s response has an invalid ' +
+          'expiration: %s' % response)
+      self.response.status = 500
+      self.response.write('API server error.')
+      return
+
+    # Drive API may have sent the sync notification before the channel is
+    # stored. Channels.Add() takes care of it.
+    synced = Channels.Add(channelId, token, gcmChannel, expiration,
+                          largestChangeId, accountId, previousChannelId)
+    if previousChannelId is not None:
+      Channels.Retire(previousChannelId, gcmChannel)
+    if synced:
+      Relay.NotifySynced([(channelId, gcmChannel)])
+    self._writeChannel(channelId, response.get('expiration'))
+
+  def _writeChannel(self, channelId, expiration):
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps({
+      'channelId': channelId,
+      'expiration': expiration,
+    }))
+
+  def _accountIdCacheKey(self):
+    # Access tokens belong to one account, so the account of a token never
+    # changes. Only a hash of the token is kept.
+    return _ACCOUNT_ID_PREFIX + hashlib.sha256(
+        self.request.headers.get('Authorization')).hexdigest()
+
+  def _getCachedAccountId(self):
+    return memcache.get(self._accountIdCacheKey())
+
+  def _parseAboutResponse(self, aboutRequest):
+    # Returns the permission id of the account, or None if it's unknown, in
+    # which case the channel gets a watch of its own.
+    try:
+      result = aboutRequest.get_result()
+      if result.status_code == 200:
+        permissionId = json.loads(result.content).get('permissionId')
+        if isinstance(permissionId, basestring) and permissionId:
+          memcache.set(self._accountIdCacheKey(), permissionId,
+                       time=_ACCOUNT_ID_CACHE_TTL)
+          return permissionId
+    except (http_client.Error, ValueError):
+      pass
+    logging.warning('Failed to get the permission id of the account.')
+    return None
+
+  def _parseWatchResponse(self, watchRequest):
+    try:
+      result = watchRequest.get_result()
+    except http_client.Error:
+      self.response.status = 500
+      self.response.write('Network error.')
+      return None
+    if result.status_code != 200:
+      self.response.status = 500
+      self.response.write('API request failed with %s.\n' % result.status_code)
+      self.response.write(result.content)
+      return None
+    try:
+      return json.loads(result.content)
+    except ValueError:
+      logging.warning('Drive API changes.watch respond with 200 but ' +
+          'the body is not valid JSON')
+      self.response.status = 500
+      self.response.write('API server error.')
+      return None
+
+  def _stopUnusedWatch(self, channelId, watchRequest):
+    # The response has already been written, so errors are ignored here. The
+    # stop request completes when the handler exits.
+    try:
+      result = watchRequest.get_result()
+      if result.status_code != 200:
+        return
+      resourceId = json.loads(result.content).get('resourceId')
+    except (http_client.Error, ValueError):
+      return
+    self._sendRequest('POST', _CHANNELS_STOP_URL, {
+      'id': channelId,
+      'resourceId': resourceId,
+    })
+
+  def _sendGetPropertyRequest(self, clientId):
+    return self._sendRequest('GET', _PROPERTY_BASE_URL +
+        urllib.quote(clientId) + _PROPERTY_REQUEST_PARAMETER)
+
+  def _parseGetPropertyResponse(self, propertyRequest):
+    try:
+      result = propertyRequest.get_result()
+    except http_client.Error:
+      self.response.status = 500
+      self.response.write('Network error.')
+      return None
+
+    if result.status_code == 200:
+      try:
+        response = json.loads(result.content)
+      except ValueError:
+        logging.warning('Drive API succeeded but returned invalid JSON.')
+        self.response.status = 500
+        self.response.write('API server error.')
+        return None
+      value = response.get('value')
+      try:
+        gcmChannel, lastUsed = value.split(_CHANNEL_TIME_SEPARATOR)
+      except ValueError:
+        self.response.status = 400
+        self.response.write('Invalid gcmChannel property value.')
+        return None
+      if not self._isValidGcmChannelId(gcmChannel):
+        self.response.status = 400
+        self.response.write('Invalid GCM channel id.')
+        return None
+      return gcmChannel
+
+    if result.status_code == 401:
+      self.response.status = 401
+    else:
+      self.response.status = 404
+    self.response.write('Drive API properties.get failed with %s.' %
+        result.status_code)
+    self.response.write(result.content)
+    return None
+
+  def _isValidGcmChannelId(self, channelId):
+    # See also https://code.google.com/p/chromium/codesearch#chromium/src/chrome/browser/extensions/api/push_messaging/push_messaging_api.cc&sq=package:chromium&type=cs&rcl=1379309038&l=220
+    # for how the channel id is generated. It should be something like
+    # <Obsfucated GAIA ID>/<Extension ID>
+    # Extension ids contain only a-p and the length is 32. See also
+    # https://code.google.com/p/chromium/codesearch#chromium/src/extensions/common/id_util.cc&sq=package:chromium&type=cs&rcl=1379309038&l=15.
+    return (channelId is not None and
+        isinstance(channelId, basestring) and
+        validation.GCM_CHANNEL_ID_REGEX.match(channelId))
+
+  def _generateChannelIdAndToken(self):
+    # Channel ids for Drive API's watch requests can only contain digits,
+    # alphabets and '-'.
+    channelId = base64.urlsafe_b64encode(
+        os.urandom(validation.CHANNEL_ID_BITS / 8)).strip('=')
+
+    # URL-safe characters are all acceptable in token.
+    token = base64.urlsafe_b64encode(
+        os.urandom(validation.CHANNEL_TOKEN_BITS / 8))
+
+    return channelId, token
+
+  def _sendWatchRequest(self, channelId, token):
+    return self._sendRequest('POST', _CHANGES_WATCH_URL, {
+      'id': channelId,
+      'token': token,
+      'type': _DRIVE_API_WATCH_TYPE,
+      'address': 'https://' + app_identity.get_default_version_hostname() +
+                 '/notify',
+      'params': {
+        'ttl': _CHANNEL_TTL,
+      }
+    })
+
+  def _refreshChannel(self, channelId, largestChangeId):
+    result = Channels.Renew(channelId, largestChangeId)
+    if result == True:
+      self.response.status = 204
+    elif result is None:
+      self.response.status = 404
+    else:
+      self.response.status = 200
+      self.response.write(result)
+
+  def _refreshChannels(self, channels):
+    if (not isinstance(channels, list) or not channels or
+        len(channels) > validation.MAX_BATCH_SIZE):
+      self.response.status = 400
+      self.response.write('Invalid channel list.')
+      return
+    renewals = []
+    for item in channels:
+      channelId, largestChangeId = (None, None)
+      if isinstance(item, dict):
+        channelId, largestChangeId = (item.get(key) for key in [
+            'channelId', 'largestChangeId'])
+      if (not isinstance(channelId, basestring) or
+          not validation.CHANNEL_ID_REGEX.match(channelId) or
+          not isinstance(largestChangeId, basestring)):
+        self.response.status = 400
+        self.response.write('Invalid channel.')
+        return
+      try:
+        renewals.append((channelId, int(largestChangeId)))
+      except ValueError:
+        self.response.status = 400
+        self.response.write('Invalid largest change ID.')
+        return
+    if len(set(channelId for channelId, _ in renewals)) != len(renewals):
+      self.response.status = 400
+      self.response.write('Duplicate channels.')
+      return
+
+    results = []
+    for result in Channels.RenewMulti(renewals):
+      if result == True:
+        results.append({'status': 204})
+      elif result is None:
+        results.append({'status': 404})
+      else:
+        results.append({'status': 200, 'largestChangeId': str(result)})
+    self.response.status = 200
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps({'results': results}))
+
+  def _sendRequest(self, method, url, body=None):
+    headers = {}
+    for header in ['Authorization', 'User-Agent']:
+      headers[header] = self.request.headers.get(header)
+    userip = 'userip=' + urllib.quote_plus(self.request.remote_addr)
+    if '?' in url:
+      url += '&' + userip
+    else:
+      url += '?' + userip
+    if body is not None:
+      body = json.dumps(body)
+      headers['Content-Type'] = 'application/json'
+    return HttpClient.FetchAsync(http_client.DRIVE, url, method=method,
+                                 payload=body, headers=headers)
+
+# GET /status
+#
+# <channelId>
+#
+# created|ready|suspended
+# created: The notification channel is established (Drive API's watch
+#     request succeeded).
+# ready: The first 'sync' notification for the channel is received and it's
+#     to receive change notifications.
+# suspended: A notification has been received and forwarded. The client will
+#     examine the change and take actions appropriately, probably making
+#     further changes. Any further notifications received are no longer
+#     forwarded until another bind request is sent.
+#
+# POST /status
+# Content-Type: application/json
+#
+# {"channelIds": [...]}
+#
+# HTTP 200 OK
+# {"statuses": ["ready", null, ...]} // null for unknown channels.
+class StatusHandler(webapp2.RequestHandler):
+  def get(self):
+    channelId = self.request.body
+    if not validation.CHANNEL_ID_REGEX.match(channelId):
+      self.response.status = 404
+      return
+
+    status = _STATUS_NAMES.get(Channels.GetStatus(channelId))
+    if status is None:
+      self.response.status = 404
+      return
+    self.response.status = 200
+    self.response.write(status)
+
+  def post(self):
+    self.response.headers['Content-Type'] = 'text/plain'
+    if len(self.request.body) > validation.MAX_BATCH_REQUEST_BODY_LEN:
+      self.response.status = 413
+      return
+    try:
+      channelIds = json.loads(self.request.body).get('channelIds')
+    except (ValueError, AttributeError):
+      self.response.status = 400
+      self.response.write('Invalid JSON.')
+      return
+    if (not isinstance(channelIds, list) or not channelIds or
+        len(channelIds) > validation.MAX_BATCH_SIZE or
+        not all(isinstance(channelId, basestring) and
+                validation.CHANNEL_ID_REGEX.match(channelId)
+                for channelId in channelIds)):
+      self.response.status = 400
+      self.response.write('Invalid channel list.')
+      return
+
+    self.response.status = 200
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps({
+      'statuses': [_STATUS_NAMES.get(status) for status in
+                   Channels.GetStatusMulti(channelIds)],
+    }))
+
+# POST /outbox
+# Content-Type: application/json
+#
+# {"channelId": ..., "largestChangeId": "1234"}
+#
+# HTTP 200 OK
+# {
+#   // Change notifications after largestChangeId that the client hasn't
+#   // acknowledged by binding, oldest first. Times are in milliseconds.
+#   "changes": [{"id": "1240", "time": 1380000000000}, ...],
+#   // False if notifications after largestChangeId were dropped because the
+#   // outbox was full or they expired, so the client has to scan for changes.
+#   "complete": true
+# }
+#
+# HTTP 404 if the channel doesn't exist or has expired.
+class OutboxHandler(webapp2.RequestHandler):
+  def post(self):
+    self.response.headers['Content-Type'] = 'text/plain'
+    if len(self.request.body) > validation.MAX_REQUEST_BODY_LEN:
+      self.response.status = 413
+      return
+    try:
+      request = json.loads(self.request.body)
+      channelId = request.get('channelId')
+      largestChangeId = int(request.get('largestChangeId'))
+    except (ValueError, TypeError, AttributeError):
+      self.response.status = 400
+      self.response.write('Invalid JSON.')
+      return
+    if (not isinstance(channelId, basestring) or
+        not validation.CHANNEL_ID_REGEX.match(channelId)):
+      self.response.status = 400
+      self.response.write('Invalid channel ID.')
+      return
+
+    outbox = Channels.GetOutbox(channelId)
+    if outbox is None:
+      self.response.status = 404
+      return
+    entries, droppedUpTo = outbox
+    self.response.status = 200
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps({
+      'changes': [{'id': str(changeId), 'time': entryTime * 1000}
+                  for changeId, entryTime in entries
+                  if changeId > largestChangeId],
+      'complete': droppedUpTo <= largestChangeId,
+    }))
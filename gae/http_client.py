@@ -0,0 +1,241 @@
+import collections
+import gzip
+import httplib
+import os
+import Queue
+import StringIO
+import threading
+import time
+import urlparse
+from google.appengine.api import urlfetch
+from stats import Stats
+
+# Outbound endpoints. Each has its own deadline and limit of requests in
+# flight per thread.
+DRIVE = 'drive'
+GCM = 'gcm'
+OAUTH = 'oauth'
+_Endpoint = collections.namedtuple('_Endpoint', ['deadline', 'maxConcurrent'])
+_ENDPOINTS = {
+  # changes.watch requests are generally slow.
+  DRIVE: _Endpoint(deadline=25, maxConcurrent=10),
+  GCM: _Endpoint(deadline=10, maxConcurrent=10),
+  OAUTH: _Endpoint(deadline=10, maxConcurrent=1),
+}
+# Request bodies at least this large are sent gzipped.
+_GZIP_MIN_SIZE = 1024
+# Google APIs only send gzipped responses to user agents containing 'gzip'.
+_GZIP_USER_AGENT_SUFFIX = ' (gzip)'
+
+# Off App Engine, requests are sent by a pool of threads over keep-alive
+# connections, at most this many idle ones per host.
+_WORKER_THREADS = 20
+_MAX_IDLE_CONNECTIONS = 10
+
+class Error(Exception):
+  # The request couldn't be completed, e.g. a network error or a deadline
+  # was exceeded.
+  pass
+
+class Response(object):
+  def __init__(self, status_code, content, headers):
+    self.status_code = status_code
+    self.content = content
+    self.headers = headers
+
+def _OnAppEngine():
+  # Also true in the development server and under testbed.
+  software = os.environ.get('SERVER_SOFTWARE', '')
+  return (software.startswith('Google App Engine/') or
+          software.startswith('Development/'))
+
+def _Decode(status_code, content, headers):
+  headers = dict((name.lower(), value) for name, value in headers.iteritems())
+  if headers.get('content-encoding') == 'gzip':
+    try:
+      content = gzip.GzipFile(fileobj=StringIO.StringIO(content)).read()
+    except (IOError, EOFError):
+      raise Error('Invalid gzip response body.')
+    del headers['content-encoding']
+  return Response(status_code, content, headers)
+
+class Fetch(object):
+  # The future of a request. get_result() returns a Response, or raises Error.
+
+  def __init__(self, wait):
+    self._wait = wait
+    self._response = None
+    self._error = None
+    self._done = False
+
+  def get_result(self):
+    if not self._done:
+      try:
+        self._response = self._wait()
+      except Error as e:
+        self._error = e
+      self._done = True
+    if self._error is not None:
+      raise self._error
+    return self._response
+
+  def wait(self):
+    try:
+      self.get_result()
+    except Error:
+      pass
+
+  def done(self):
+    return self._done
+
+class _UrlFetchTransport(object):
+  # urlfetch keeps connections to Google APIs alive on its own.
+
+  def Start(self, url, method, payload, headers, deadline):
+    rpc = urlfetch.create_rpc(deadline=deadline)
+    urlfetch.make_fetch_call(rpc, url, payload=payload, method=method,
+                             headers=headers)
+
+    def Wait():
+      try:
+        result = rpc.get_result()
+      except urlfetch.Error as e:
+        raise Error(str(e) or e.__class__.__name__)
+      return _Decode(result.status_code, result.content, result.headers)
+    return Wait
+
+class _PooledTransport(object):
+  # Sends requests with httplib from a pool of worker threads, reusing
+  # connections to the same host.
+
+  def __init__(self):
+    self._jobs = Queue.Queue()
+    self._lock = threading.Lock()
+    self._idle = {}
+    for _ in xrange(_WORKER_THREADS):
+      worker = threading.Thread(target=self._Work)
+      worker.daemon = True
+      worker.start()
+
+  def _Work(self):
+    while True:
+      job, done = self._jobs.get()
+      job()
+      done.set()
+
+  def _Connect(self, scheme, host, deadline):
+    with self._lock:
+      idle = self._idle.get((scheme, host))
+      if idle:
+        return idle.pop(), True
+    connectionClass = (httplib.HTTPSConnection if scheme == 'https' else
+                       httplib.HTTPConnection)
+    return connectionClass(host, timeout=deadline), False
+
+  def _Release(self, scheme, host, connection):
+    with self._lock:
+      idle = self._idle.setdefault((scheme, host), [])
+      if len(idle) < _MAX_IDLE_CONNECTIONS:
+        idle.append(connection)
+        return
+    connection.close()
+
+  def _Send(self, url, method, payload, headers, deadline):
+    parsed = urlparse.urlsplit(url)
+    path = parsed.path or '/'
+    if parsed.query:
+      path += '?' + parsed.query
+    while True:
+      connection, reused = self._Connect(parsed.scheme, parsed.netloc,
+                                         deadline)
+      try:
+        connection.timeout = deadline
+        connection.request(method, path, payload, headers)
+        response = connection.getresponse()
+        content = response.read()
+      except (httplib.HTTPException, IOError) as e:
+        connection.close()
+        if reused:
+          # The server may have closed the idle connection, try a new one.
+          continue
+        raise Error(str(e) or e.__class__.__name__)
+      if response.will_close:
+        connection.close()
+      else:
+        self._Release(parsed.scheme, parsed.netloc, connection)
+      return _Decode(response.status, content, dict(response.getheaders()))
+
+  def Start(self, url, method, payload, headers, deadline):
+    result = {}
+    done = threading.Event()
+
+    def Job():
+      start = time.time()
+      try:
+        result['response'] = self._Send(url, method, payload, headers,
+                                        deadline)
+      except Error as e:
+        result['error'] = e
+      except Exception as e:
+        result['error'] = Error(str(e) or e.__class__.__name__)
+      Stats.Record('http.%s' % urlparse.urlsplit(url).netloc,
+                   time.time() - start)
+
+    self._jobs.put((Job, done))
+
+    def Wait():
+      done.wait()
+      if 'error' in result:
+        raise result['error']
+      return result['response']
+    return Wait
+
+_transport = [None]
+_transportLock = threading.Lock()
+_local = threading.local()
+
+def _Transport():
+  if _transport[0] is None:
+    with _transportLock:
+      if _transport[0] is None:
+        _transport[0] = (_UrlFetchTransport() if _OnAppEngine() else
+                         _PooledTransport())
+  return _transport[0]
+
+class HttpClient(object):
+  @staticmethod
+  def FetchAsync(endpoint, url, method='GET', payload=None, headers=None):
+    # Starts a request to one of the endpoints above and returns its Fetch.
+    # When the calling thread already has the endpoint's limit of requests
+    # in flight, waits for the oldest one first.
+    config = _ENDPOINTS[endpoint]
+    headers = dict((name, value) for name, value in (headers or {}).iteritems()
+                   if value is not None)
+    headers['Accept-Encoding'] = 'gzip'
+    headers['User-Agent'] = ((headers.get('User-Agent') or '') +
+                             _GZIP_USER_AGENT_SUFFIX).lstrip()
+    if payload is not None and len(payload) >= _GZIP_MIN_SIZE:
+      compressed = StringIO.StringIO()
+      with gzip.GzipFile(fileobj=compressed, mode='wb') as writer:
+        writer.write(payload)
+      payload = compressed.getvalue()
+      headers['Content-Encoding'] = 'gzip'
+
+    inFlight = HttpClient._InFlight(endpoint)
+    while len(inFlight) >= config.maxConcurrent:
+      inFlight.pop(0).wait()
+    fetch = Fetch(_Transport().Start(url, method, payload, headers,
+                                     config.deadline))
+    inFlight.append(fetch)
+    return fetch
+
+  @staticmethod
+  def _InFlight(endpoint):
+    # Requests are waited for in the thread that started them.
+    inFlight = getattr(_local, 'inFlight', None)
+    if inFlight is None:
+      inFlight = _local.inFlight = {}
+    requests = [fetch for fetch in inFlight.get(endpoint, [])
+                if not fetch.done()]
+    inFlight[endpoint] = requests
+    return requests
@@ -0,0 +1,148 @@
+"""Fake Drive, GCM and OAuth servers behind the urlfetch API.
+
+FakeUrlFetchStub replaces the urlfetch service stub, so that the relay can be
+exercised without network access. Each fake service has a configurable latency
+and error rate. Latency is simulated per RPC, so that concurrent async fetches
+overlap like they would in production.
+"""
+
+import json
+import random
+import threading
+import time
+import urlparse
+from google.appengine.api import apiproxy_rpc, apiproxy_stub
+
+GAIA_ID_BASE = 1000
+EXTENSION_ID = 'bjajfhkjlejiflopbocmfjijlomojaof'
+
+class FakeService(object):
+  def __init__(self, latency=0.0, errorRate=0.0):
+    # |latency| is the mean response time in seconds. Actual times are spread
+    # evenly between half and one and a half of it.
+    self.latency = latency
+    self.errorRate = errorRate
+    self.requests = 0
+    self.errors = 0
+
+  def SampleLatency(self):
+    return self.latency * random.uniform(0.5, 1.5)
+
+  def ShouldFail(self):
+    return random.random() < self.errorRate
+
+class _DelayedRPC(apiproxy_rpc.RPC):
+  # The latency starts when the call is made, not when it's waited for, so
+  # that several outstanding RPCs wait concurrently.
+
+  def _MakeCallImpl(self):
+    self._readyAt = time.time() + self.stub.SampleLatency(self.request)
+    apiproxy_rpc.RPC._MakeCallImpl(self)
+
+  def _WaitImpl(self):
+    delay = self._readyAt - time.time()
+    if delay > 0:
+      time.sleep(delay)
+    return apiproxy_rpc.RPC._WaitImpl(self)
+
+class FakeUrlFetchStub(apiproxy_stub.APIProxyStub):
+  def __init__(self, drive=None, gcm=None, oauth=None):
+    apiproxy_stub.APIProxyStub.__init__(self, 'urlfetch')
+    self.drive = drive or FakeService()
+    self.gcm = gcm or FakeService()
+    self.oauth = oauth or FakeService()
+    self._lock = threading.Lock()
+    # (channelId, token) of the watches created through changes.watch that
+    # haven't been stopped.
+    self.watches = []
+    self.createdWatches = 0
+    self.stoppedWatches = 0
+    # Number of push messages accepted per GCM channel id.
+    self.pushes = {}
+    self.tokensIssued = 0
+
+  def CreateRPC(self):
+    return _DelayedRPC(stub=self)
+
+  def _Service(self, url):
+    host = urlparse.urlparse(url).netloc
+    if host == 'accounts.google.com':
+      return self.oauth
+    if '/gcm_for_chrome/' in url:
+      return self.gcm
+    return self.drive
+
+  def SampleLatency(self, request):
+    return self._Service(request.url()).SampleLatency()
+
+  def _Dynamic_Fetch(self, request, response):
+    url = request.url()
+    service = self._Service(url)
+    headers = dict((header.key().lower(), header.value())
+                   for header in request.header_list())
+    with self._lock:
+      service.requests += 1
+      if service.ShouldFail():
+        service.errors += 1
+        status, body = 503, 'Backend Error'
+      else:
+        status, body = self._Handle(urlparse.urlparse(url).path, headers,
+                                    request.payload())
+    response.set_statuscode(status)
+    response.set_content(body)
+    header = response.add_header()
+    header.set_key('Content-Type')
+    header.set_value('application/json')
+
+  def _Account(self, headers):
+    # Tests authorize as 'Bearer account-<n>'.
+    authorization = headers.get('authorization') or ''
+    try:
+      return int(authorization.rsplit('-', 1)[1])
+    except (IndexError, ValueError):
+      return None
+
+  def _Handle(self, path, headers, payload):
+    if path.lstrip('/') == 'o/oauth2/token':
+      self.tokensIssued += 1
+      return 200, json.dumps({
+        'access_token': 'access-token-%d' % self.tokensIssued,
+        'expires_in': 3600,
+      })
+    if path.endswith('/gcm_for_chrome/v1/messages'):
+      message = json.loads(payload)
+      self.pushes[message['channelId']] = (
+          self.pushes.get(message['channelId'], 0) + 1)
+      return 204, ''
+
+    account = self._Account(headers)
+    if account is None:
+      return 401, json.dumps({'error': 'Invalid Credentials'})
+    if path.startswith('/drive/v2/files/root/properties/'):
+      return 200, json.dumps({
+        'value': '%d/%s|%d' % (GAIA_ID_BASE + account, EXTENSION_ID,
+                               time.time() * 1000),
+      })
+    if path == '/drive/v2/about':
+      return 200, json.dumps({'permissionId': 'permission-%d' % account})
+    if path == '/drive/v2/changes/watch':
+      watch = json.loads(payload)
+      self.watches.append((watch['id'], watch['token']))
+      self.createdWatches += 1
+      return 200, json.dumps({
+        'kind': 'api#channel',
+        'id': watch['id'],
+        'resourceId': 'resource-%d' % account,
+        'expiration': str(int((time.time() + watch['params']['ttl']) * 1000)),
+      })
+    if path == '/drive/v2/channels/stop':
+      channelId = json.loads(payload)['id']
+      self.watches = [watch for watch in self.watches
+                      if watch[0] != channelId]
+      self.stoppedWatches += 1
+      return 204, ''
+    return 404, json.dumps({'error': 'Not Found'})
+
+  def TotalPushes(self):
+    with self._lock:
+      return sum(self.pushes.values())
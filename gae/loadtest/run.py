@@ -0,0 +1,417 @@
+"""Offline load test and benchmark driver for the relay backend.
+
+Runs the relay's WSGI app in process against the App Engine testbed stubs and
+fake Drive, GCM and OAuth servers (see fakes.py). No network access is needed.
+
+Usage:
+  python loadtest/run.py --sdk /path/to/google_appengine [scenario ...]
+
+Scenarios: burst, duplicate, bindstorm, cleanup, coldstart. All of them run by
+default. --storage selects the channel store, e.g. memory or
+sqlite:/tmp/relay.db to benchmark the relay state machine without the
+datastore stub.
+For each endpoint the driver reports p50/p99 latency and the datastore RPCs
+per request, and for notifications the push messages sent per notification.
+The coldstart scenario starts a new process per endpoint and reports the time
+to import the app, the latency of the first and second request and the
+modules loaded by the first request, with and without a warmup request.
+"""
+
+import argparse
+import json
+import os
+import Queue
+import subprocess
+import sys
+import threading
+import time
+
+_GAE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_PUSH_QUEUES = ['push-worker', 'coalesce', 'renewal', 'cron']
+_COLD_START_ENDPOINTS = ['notify', 'bind', 'status']
+
+def _SetUpPaths(sdk):
+  sys.path.insert(0, sdk)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  sys.path.insert(0, _GAE_DIR)
+  sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+class Recorder(object):
+  # Counts API calls made by the thread handling each request, and collects
+  # per-endpoint results.
+
+  def __init__(self):
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self.results = {}
+
+  def Hook(self, service, call, request, response):
+    counts = getattr(self._local, 'counts', None)
+    if counts is not None:
+      counts[service] = counts.get(service, 0) + 1
+
+  def Measure(self, endpoint, function):
+    self._local.counts = {}
+    start = time.time()
+    try:
+      return function()
+    finally:
+      elapsed = time.time() - start
+      counts, self._local.counts = self._local.counts, None
+      with self._lock:
+        self.results.setdefault(endpoint, []).append((elapsed, counts))
+
+  def Reset(self):
+    with self._lock:
+      self.results = {}
+
+  def Report(self, title):
+    print '\n== %s ==' % title
+    print '%-22s %7s %9s %9s %10s %10s' % ('endpoint', 'count', 'p50 ms',
+        'p99 ms', 'datastore', 'memcache')
+    for endpoint in sorted(self.results):
+      results = self.results[endpoint]
+      latencies = sorted(elapsed for elapsed, _ in results)
+      perRequest = lambda service: (sum(counts.get(service, 0) for _, counts
+                                        in results) / float(len(results)))
+      print '%-22s %7d %9.1f %9.1f %10.2f %10.2f' % (endpoint, len(results),
+          _Percentile(latencies, 0.5) * 1000,
+          _Percentile(latencies, 0.99) * 1000,
+          perRequest('datastore_v3'), perRequest('memcache'))
+
+def _Percentile(values, fraction):
+  if not values:
+    return 0
+  return values[int(round(fraction * (len(values) - 1)))]
+
+class Harness(object):
+  def __init__(self, args):
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import ndb, testbed
+    import fakes
+    import webtest
+
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.setup_env(app_id='gsoc-drive-client',
+                           CURRENT_VERSION_ID='loadtest.1',
+                           DEFAULT_VERSION_HOSTNAME='localhost',
+                           overwrite=True)
+    self.testbed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1),
+        require_indexes=False)
+    self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub(root_path=_GAE_DIR)
+    self.testbed.init_app_identity_stub()
+    self.urlfetch = fakes.FakeUrlFetchStub(
+        drive=fakes.FakeService(args.drive_latency, args.error_rate),
+        gcm=fakes.FakeService(args.gcm_latency, args.error_rate),
+        oauth=fakes.FakeService(args.oauth_latency, 0))
+    apiproxy_stub_map.apiproxy.RegisterStub('urlfetch', self.urlfetch)
+    self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    import storage
+    storage.SetBackend(storage.CreateBackend(args.storage))
+
+    self.recorder = Recorder()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'loadtest', self.recorder.Hook)
+
+    start = time.time()
+    import handler
+    self.importSeconds = time.time() - start
+    import push_messaging
+    push_messaging._CLIENT_ID = 'client-id'
+    push_messaging._CLIENT_SECRET = 'client-secret'
+    push_messaging._REFRESH_TOKEN = 'refresh-token'
+    # Every request gets a fresh ndb context, like in production.
+    self.app = webtest.TestApp(ndb.toplevel(handler.app))
+    self.concurrency = args.concurrency
+    self.notifications = 0
+    self._lock = threading.Lock()
+
+  def TearDown(self):
+    self.testbed.deactivate()
+
+  def Request(self, endpoint, method, url, body='', headers=None):
+    return self.recorder.Measure(endpoint, lambda: self.app.request(url,
+        method=method, body=body, headers=headers or {},
+        extra_environ={'REMOTE_ADDR': '10.0.0.1'}, expect_errors=True))
+
+  def RunConcurrently(self, calls):
+    pending = Queue.Queue()
+    for call in calls:
+      pending.put(call)
+
+    def Worker():
+      while True:
+        try:
+          call = pending.get_nowait()
+        except Queue.Empty:
+          return
+        call()
+
+    workers = [threading.Thread(target=Worker)
+               for _ in xrange(self.concurrency)]
+    for worker in workers:
+      worker.start()
+    for worker in workers:
+      worker.join()
+
+  def RunTasks(self, wait=True):
+    # Runs due tasks of all push queues. With |wait|, keeps going until no
+    # tasks are left, waiting for tasks scheduled in the future.
+    while True:
+      nextEta = None
+      ran = False
+      for queueName in _PUSH_QUEUES:
+        for task in self.taskqueue.get_filtered_tasks(queue_names=[queueName]):
+          if task.eta_posix > time.time():
+            if nextEta is None or task.eta_posix < nextEta:
+              nextEta = task.eta_posix
+            continue
+          self.taskqueue.DeleteTask(queueName, task.name)
+          headers = dict(task.headers)
+          headers['X-AppEngine-QueueName'] = queueName
+          self.Request('task ' + task.url.split('?')[0], task.method,
+                       task.url, task.payload or '', headers)
+          ran = True
+      if ran:
+        continue
+      if nextEta is None or not wait:
+        return
+      time.sleep(max(0, nextEta - time.time()))
+
+  def Bind(self, account, clientId, largestChangeId=1):
+    response = self.Request('/bind (first)', 'POST', '/bind', json.dumps({
+      'clientId': clientId,
+      'largestChangeId': str(largestChangeId),
+    }), {
+      'Authorization': 'Bearer account-%d' % account,
+      'Content-Type': 'application/json',
+    })
+    if response.status_int != 200:
+      return None
+    return response.json['channelId']
+
+  def Renew(self, channelId, largestChangeId):
+    return self.Request('/bind (renew)', 'POST', '/bind', json.dumps({
+      'channelId': channelId,
+      'largestChangeId': str(largestChangeId),
+    }), {'Content-Type': 'application/json'})
+
+  def Notify(self, channelId, token, state, changeId=None):
+    if state == 'change':
+      with self._lock:
+        self.notifications += 1
+    body = ''
+    if changeId is not None:
+      body = json.dumps({'kind': 'drive#change', 'id': str(changeId)})
+    return self.Request('/notify (%s)' % state, 'POST', '/notify', body, {
+      'X-Goog-Channel-ID': channelId,
+      'X-Goog-Channel-Token': token,
+      'X-Goog-Resource-State': state,
+    })
+
+  def SetUpChannels(self, accounts, clientsPerAccount):
+    # Binds clients and delivers the sync notification of each new watch.
+    self.RunConcurrently([
+        (lambda account=account, client=client:
+             self.Bind(account, 'client%022d%04d' % (account, client)))
+        for account in xrange(accounts)
+        for client in xrange(clientsPerAccount)])
+    watches = list(self.urlfetch.watches)
+    self.RunConcurrently([
+        (lambda channelId=channelId, token=token:
+             self.Notify(channelId, token, 'sync'))
+        for channelId, token in watches])
+    self.RunTasks()
+    return watches
+
+  def ReportPushes(self, title):
+    self.recorder.Report(title)
+    pushes = self.urlfetch.TotalPushes()
+    print ('push messages: %d, change notifications: %d, ' +
+           'pushes/notification: %.2f') % (pushes, self.notifications,
+           pushes / float(max(self.notifications, 1)))
+    print 'Drive requests: %d (%d errors), GCM requests: %d (%d errors)' % (
+        self.urlfetch.drive.requests, self.urlfetch.drive.errors,
+        self.urlfetch.gcm.requests, self.urlfetch.gcm.errors)
+
+def Burst(harness, args):
+  # Many change notifications for each channel in quick succession, like a
+  # heavy editing session.
+  watches = harness.SetUpChannels(args.accounts, 1)
+  harness.recorder.Reset()
+  calls = []
+  for channelId, token in watches:
+    for changeId in xrange(2, 2 + args.changes):
+      calls.append(lambda channelId=channelId, token=token, changeId=changeId:
+                   harness.Notify(channelId, token, 'change', changeId))
+  harness.RunConcurrently(calls)
+  harness.RunTasks()
+  harness.ReportPushes('burst: %d channels x %d changes' % (len(watches),
+                                                            args.changes))
+
+def Duplicate(harness, args):
+  # Drive redelivers the same notification several times.
+  watches = harness.SetUpChannels(args.accounts, 1)
+  harness.recorder.Reset()
+  harness.RunConcurrently([
+      (lambda channelId=channelId, token=token:
+           harness.Notify(channelId, token, 'change', 2))
+      for channelId, token in watches for _ in xrange(args.duplicates)])
+  harness.RunTasks()
+  harness.ReportPushes('duplicate: %d channels x %d deliveries' % (
+      len(watches), args.duplicates))
+
+def BindStorm(harness, args):
+  # All clients bind at once, then resume their channels at once.
+  harness.recorder.Reset()
+  harness.SetUpChannels(args.accounts, args.clients)
+  import models
+  import storage
+  channelIds = []
+  cursor = None
+  more = True
+  while more:
+    ids, cursor, more = storage.GetBackend().QueryByExpiration(
+        models.RelayChannel, None, None, 1000, cursor, keysOnly=True)
+    channelIds.extend(ids)
+  harness.RunConcurrently([
+      (lambda channelId=channelId: harness.Renew(channelId, 1))
+      for channelId in channelIds])
+  harness.ReportPushes('bindstorm: %d accounts x %d clients' % (args.accounts,
+                                                                args.clients))
+  print 'Drive watches created: %d, stopped: %d' % (
+      harness.urlfetch.createdWatches, harness.urlfetch.stoppedWatches)
+
+def Cleanup(harness, args):
+  # Removes a backlog of expired channels.
+  from datetime import datetime, timedelta
+  import models
+  import storage
+  expiration = datetime.now() - timedelta(hours=1)
+  storage.GetBackend().PutMulti([
+      models.RelayChannel(id='expired%036d' % index, expiration=expiration,
+                          changeIdAndStatus=0)
+      for index in xrange(args.expired)])
+  harness.recorder.Reset()
+  harness.Request('/cron', 'GET', '/cron')
+  harness.RunTasks()
+  harness.recorder.Report('cleanup: %d expired channels' % args.expired)
+  print 'remaining channels: %d' % storage.GetBackend().CountByExpiration(
+      models.RelayChannel, datetime.max, args.expired)
+
+def _ColdRequests(harness, endpoint):
+  # Returns the first and second request to |endpoint| on a new instance.
+  if endpoint == 'notify':
+    # The channel is stored directly, so that no other handler is loaded.
+    from datetime import datetime, timedelta
+    import models
+    import storage
+    channelId, token = 'c' * 43, 't' * 171 + '='
+    storage.GetBackend().PutMulti([models.RelayChannel(id=channelId,
+        tokenHash=models.HashToken(token), gcmChannelId='1/' + 'a' * 32,
+        expiration=datetime.now() + timedelta(hours=1),
+        changeIdAndStatus=(1 << models.CHANGE_ID_SHIFT) | models.STATUS_READY)])
+    return [lambda changeId=changeId:
+                harness.Notify(channelId, token, 'change', changeId)
+            for changeId in (2, 3)]
+  if endpoint == 'bind':
+    return [lambda client=client:
+                harness.Bind(client, 'client%026d' % client)
+            for client in (0, 1)]
+  return [lambda: harness.Request('/status', 'GET', '/status', 'c' * 43)] * 2
+
+def _MeasureColdStart(args):
+  # Runs in a new process, see ColdStart().
+  harness = Harness(args)
+  try:
+    if args.warm:
+      harness.Request('/_ah/warmup', 'GET', '/_ah/warmup')
+    first, second = _ColdRequests(harness, args.cold_endpoint)
+    modules = len(sys.modules)
+    start = time.time()
+    first()
+    firstSeconds = time.time() - start
+    modules = len(sys.modules) - modules
+    start = time.time()
+    second()
+    return {
+      'importMs': harness.importSeconds * 1000,
+      'firstMs': firstSeconds * 1000,
+      'secondMs': (time.time() - start) * 1000,
+      'modules': modules,
+    }
+  finally:
+    harness.TearDown()
+
+def ColdStart(harness, args):
+  # Each endpoint is measured in a fresh interpreter, like a new instance.
+  print '\n== coldstart =='
+  print '%-8s %6s %10s %9s %10s %8s' % ('endpoint', 'warmup', 'import ms',
+      'first ms', 'second ms', 'modules')
+  for endpoint in _COLD_START_ENDPOINTS:
+    for warm in (False, True):
+      command = [sys.executable, os.path.abspath(__file__), '--sdk', args.sdk,
+                 '--storage', args.storage, '--cold-endpoint', endpoint]
+      if warm:
+        command.append('--warm')
+      result = json.loads(subprocess.check_output(command).splitlines()[-1])
+      print '%-8s %6s %10.1f %9.1f %10.1f %8d' % (endpoint,
+          'yes' if warm else 'no', result['importMs'], result['firstMs'],
+          result['secondMs'], result['modules'])
+
+_SCENARIOS = {
+  'burst': Burst,
+  'duplicate': Duplicate,
+  'bindstorm': BindStorm,
+  'cleanup': Cleanup,
+  'coldstart': ColdStart,
+}
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--sdk', required=True,
+                      help='Path to the App Engine Python SDK.')
+  parser.add_argument('--storage', default='ndb',
+                      help='Storage backend: ndb, memory or sqlite:<path>.')
+  parser.add_argument('--concurrency', type=int, default=8)
+  parser.add_argument('--accounts', type=int, default=20)
+  parser.add_argument('--clients', type=int, default=3,
+                      help='Clients per account in the bindstorm scenario.')
+  parser.add_argument('--changes', type=int, default=20,
+                      help='Change notifications per channel in a burst.')
+  parser.add_argument('--duplicates', type=int, default=5)
+  parser.add_argument('--expired', type=int, default=2000)
+  parser.add_argument('--drive-latency', type=float, default=0.2)
+  parser.add_argument('--gcm-latency', type=float, default=0.1)
+  parser.add_argument('--oauth-latency', type=float, default=0.1)
+  parser.add_argument('--error-rate', type=float, default=0.0)
+  # Used by the coldstart scenario for its child processes.
+  parser.add_argument('--cold-endpoint', choices=_COLD_START_ENDPOINTS,
+                      help=argparse.SUPPRESS)
+  parser.add_argument('--warm', action='store_true', help=argparse.SUPPRESS)
+  parser.add_argument('scenarios', nargs='*', metavar='scenario')
+  args = parser.parse_args()
+  for name in args.scenarios:
+    if name not in _SCENARIOS:
+      parser.error('Unknown scenario: %s' % name)
+  _SetUpPaths(args.sdk)
+  if args.cold_endpoint:
+    print json.dumps(_MeasureColdStart(args))
+    return
+
+  for name in args.scenarios or sorted(_SCENARIOS):
+    harness = Harness(args)
+    try:
+      _SCENARIOS[name](harness, args)
+    finally:
+      harness.TearDown()
+
+if __name__ == '__main__':
+  main()
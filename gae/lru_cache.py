@@ -0,0 +1,63 @@
+import collections
+import threading
+import time
+
+class LruCache(object):
+  # A thread-safe in-instance cache. Entries are evicted when they are older
+  # than |ttl| seconds or when the cache holds more than |capacity| entries.
+
+  def __init__(self, capacity, ttl):
+    self._capacity = capacity
+    self._ttl = ttl
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def Get(self, key, default_value=None):
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is None or entry[1] < time.time():
+        self.misses += 1
+        return default_value
+      # Move the entry to the most recently used end.
+      self._entries[key] = entry
+      self.hits += 1
+      return entry[0]
+
+  def Set(self, key, value, ttl=None):
+    expires_at = time.time() + (self._ttl if ttl is None else ttl)
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (value, expires_at)
+      while len(self._entries) > self._capacity:
+        self._entries.popitem(last=False)
+
+  def Delete(self, key):
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def DeleteMulti(self, keys):
+    with self._lock:
+      for key in keys:
+        self._entries.pop(key, None)
+
+  def Items(self):
+    # Returns a snapshot of the unexpired (key, value) pairs, least recently
+    # used first, without counting them as used.
+    now = time.time()
+    with self._lock:
+      return [(key, entry[0]) for key, entry in self._entries.iteritems()
+              if entry[1] >= now]
+
+  def Clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def Stats(self):
+    with self._lock:
+      return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'size': len(self._entries),
+      }
@@ -1,11 +1,64 @@
+import hashlib
 from google.appengine.ext import ndb
+
+def HashToken(token):
+  return hashlib.sha256(token).digest()
+
+def _ConstantTimeEquals(a, b):
+  if len(a) != len(b):
+    return False
+  result = 0
+  for x, y in zip(a, b):
+    result |= ord(x) ^ ord(y)
+  return result == 0
+
+# Only expiration is queried, all other properties are unindexed.
 class RelayChannel(ndb.Model):
-  gcmChannelId = ndb.StringProperty()
-  token = ndb.StringProperty()
+  # Channels does its own caching in instance memory and memcache.
+  _use_memcache = False
+
+  gcmChannelId = ndb.StringProperty(indexed=False)
+  # SHA-256 digest of the token of the Drive watch.
+  tokenHash = ndb.BlobProperty()
+  # The token in plain text, as stored by earlier versions. It's replaced by
+  # tokenHash the next time the channel is written.
+  legacyToken = ndb.StringProperty('token', indexed=False)
   expiration = ndb.DateTimeProperty()
-  # The most significant two bits represent the status and the remaining bits
+  # The least significant two bits represent the status and the remaining bits
   # represent the largest change id.
-  changeIdAndStatus = ndb.IntegerProperty()
+  changeIdAndStatus = ndb.IntegerProperty(indexed=False)
+  # The first change id the client hasn't acknowledged by binding, or None if
+  # it follows the largest change id. Together with the number of change
+  # notifications since the last bind, it's relayed with changes so that
+  # clients can fetch just the delta.
+  firstChangeId = ndb.IntegerProperty(indexed=False)
+  notificationCount = ndb.IntegerProperty(indexed=False, default=0)
+  # Change notifications the client hasn't acknowledged, see outbox.py.
+  outbox = ndb.BlobProperty()
+  # Channels of other clients of the same account that share the Drive watch
+  # of this channel. Only set on the channel that created the watch.
+  subscriberIds = ndb.StringProperty(repeated=True, indexed=False)
+  # For channels that share another channel's Drive watch, the id of that
+  # channel. These channels have no token of their own.
+  watchId = ndb.StringProperty(indexed=False)
+
+  def VerifyTokenHash(self, tokenHash):
+    if self.tokenHash is not None:
+      return _ConstantTimeEquals(self.tokenHash, tokenHash)
+    if self.legacyToken is not None:
+      return _ConstantTimeEquals(HashToken(self.legacyToken), tokenHash)
+    return False
+
+  def _pre_put_hook(self):
+    if self.legacyToken is not None:
+      self.tokenHash = HashToken(self.legacyToken)
+      self.legacyToken = None
+
+# The Drive watch of an account that new channels of the account share. Keyed
+# by the permission id of the account.
+class AccountWatch(ndb.Model):
+  channelId = ndb.StringProperty(indexed=False)
+  expiration = ndb.DateTimeProperty(indexed=False)
 
 STATUS_SHIFT = 62
 # The relay channel is created but the first sync notification from Drive API
@@ -0,0 +1,78 @@
+import json
+import logging
+import webapp2
+from channels import Channels
+from rate_limit import RateLimiter
+from relay import Relay
+from stats import Stats
+import validation
+
+# Admission control of /notify, in notifications per second and burst size.
+# A channel normally gets a few notifications per second at most; Drive
+# retries notifications rejected with 503 with exponential backoff. Instances
+# take tokens from memcache in blocks of the lease size, see RateLimiter.
+_NOTIFY_CHANNEL_RATE = 5
+_NOTIFY_CHANNEL_BURST = 20
+_NOTIFY_CHANNEL_LEASE = 5
+_NOTIFY_GLOBAL_RATE = 500
+_NOTIFY_GLOBAL_BURST = 1000
+_NOTIFY_GLOBAL_LEASE = 10
+
+# According to https://developers.google.com/drive/push#msg-format, request
+# body for change notifications is very small and 256 should be enough.
+_DRIVE_KIND_CHANGE = 'drive#change'
+_GOOG_RESOURCE_STATE_SYNC = 'sync'
+_GOOG_RESOURCE_STATE_CHANGE = 'change'
+
+_channelLimiter = RateLimiter('notify/channel', _NOTIFY_CHANNEL_RATE,
+                              _NOTIFY_CHANNEL_BURST, _NOTIFY_CHANNEL_LEASE)
+_globalLimiter = RateLimiter('notify/global', _NOTIFY_GLOBAL_RATE,
+                             _NOTIFY_GLOBAL_BURST, _NOTIFY_GLOBAL_LEASE)
+
+class NotificationsHandler(webapp2.RequestHandler):
+  def post(self):
+    # There's no point setting the appropriate status code for fatal errors.
+    self.response.status = 200
+
+    channelId, token, state = (self.request.headers.get(name) for name in
+        ['X-Goog-Channel-ID', 'X-Goog-Channel-Token', 'X-Goog-Resource-State'])
+
+    largestChangeId = None
+
+    # Sanity checks.
+    if channelId is None or token is None:
+      return
+    if (not validation.CHANNEL_ID_REGEX.match(channelId) or
+        not validation.CHANNEL_TOKEN_REGEX.match(token)):
+      return
+    # A flooding channel is shed before it takes tokens of the global limit.
+    if not _channelLimiter.Admit(channelId):
+      Stats.Count('notify.shed.channel')
+      self.response.status = 503
+      return
+    if not _globalLimiter.Admit():
+      Stats.Count('notify.shed.global')
+      self.response.status = 503
+      return
+    # Drive keeps notifying removed channels until their watch expires.
+    if Channels.IsDead(channelId):
+      Stats.Count('notify.deadChannel')
+      return
+
+    if state == _GOOG_RESOURCE_STATE_SYNC:
+      Relay.Sync(channelId, token)
+
+    elif state == _GOOG_RESOURCE_STATE_CHANGE:
+      # Check request body and extract the change id if any.
+      if self.request.body:
+        if len(self.request.body) > validation.MAX_REQUEST_BODY_LEN:
+          return
+        try:
+          body = json.loads(self.request.body)
+          if body.get('kind') != _DRIVE_KIND_CHANGE:
+            return
+          largestChangeId = int(body.get('id'))
+        except (ValueError, TypeError):
+          return
+      logging.info('largestChangeId: %s' % largestChangeId)
+      Relay.Change(channelId, token, largestChangeId)
@@ -0,0 +1,96 @@
+import time
+
+# Each channel keeps the change notifications its client hasn't acknowledged
+# by binding, so that a client coming back online learns what it missed in one
+# request instead of scanning for changes. At most _MAX_ENTRIES are kept, for
+# at most _TTL seconds.
+_MAX_ENTRIES = 64
+_TTL = 3 * 24 * 60 * 60
+
+def _EncodeVarint(value, output):
+  while value > 0x7f:
+    output.append(chr(value & 0x7f | 0x80))
+    value >>= 7
+  output.append(chr(value))
+
+def _DecodeVarints(data):
+  values = []
+  value = shift = 0
+  for byte in data:
+    byte = ord(byte)
+    value |= (byte & 0x7f) << shift
+    shift += 7
+    if not byte & 0x80:
+      values.append(value)
+      value = shift = 0
+  return values
+
+class Outbox(object):
+  # An outbox is encoded as varints: the largest change id that was dropped
+  # before the client acknowledged it, or 0, followed by the change id and the
+  # time in seconds of each entry, oldest first. Both are deltas from the
+  # previous entry, change ids starting from the dropped one.
+
+  @staticmethod
+  def Decode(data, now=None):
+    # Returns the unexpired (changeId, time) entries and the largest change id
+    # dropped, including expired entries.
+    if not data:
+      return [], 0
+    values = _DecodeVarints(data)
+    droppedUpTo = changeId = values[0]
+    entryTime = 0
+    entries = []
+    for index in xrange(1, len(values) - 1, 2):
+      changeId += values[index]
+      entryTime += values[index + 1]
+      entries.append((changeId, entryTime))
+    return Outbox._Expire(entries, droppedUpTo,
+                          time.time() if now is None else now)
+
+  @staticmethod
+  def _Expire(entries, droppedUpTo, now):
+    expired = [entry for entry in entries if entry[1] < now - _TTL]
+    if expired:
+      droppedUpTo = max(droppedUpTo, expired[-1][0])
+    return entries[len(expired):], droppedUpTo
+
+  @staticmethod
+  def Encode(entries, droppedUpTo):
+    # Returns None for an empty outbox.
+    if not entries and not droppedUpTo:
+      return None
+    output = []
+    _EncodeVarint(droppedUpTo, output)
+    changeId, entryTime = droppedUpTo, 0
+    for nextChangeId, nextTime in entries:
+      _EncodeVarint(nextChangeId - changeId, output)
+      _EncodeVarint(max(0, nextTime - entryTime), output)
+      changeId, entryTime = nextChangeId, max(entryTime, nextTime)
+    return ''.join(output)
+
+  @staticmethod
+  def Append(data, changeId, now=None):
+    # Adds a notification of |changeId|, which must be larger than the ones
+    # in the outbox, dropping the oldest entries beyond _MAX_ENTRIES.
+    now = time.time() if now is None else now
+    entries, droppedUpTo = Outbox.Decode(data, now)
+    if entries and entries[-1][0] >= changeId or changeId <= droppedUpTo:
+      return data
+    entries.append((changeId, int(now)))
+    if len(entries) > _MAX_ENTRIES:
+      droppedUpTo = max(droppedUpTo, entries[-_MAX_ENTRIES - 1][0])
+      entries = entries[-_MAX_ENTRIES:]
+    return Outbox.Encode(entries, droppedUpTo)
+
+  @staticmethod
+  def Trim(data, largestChangeId):
+    # Drops the entries acknowledged by a client that has seen
+    # |largestChangeId|.
+    if not data:
+      return data
+    entries, droppedUpTo = Outbox.Decode(data)
+    if droppedUpTo <= largestChangeId:
+      droppedUpTo = 0
+    return Outbox.Encode([entry for entry in entries
+                          if entry[0] > largestChangeId], droppedUpTo)
@@ -0,0 +1,156 @@
+import json
+import os
+import random
+import threading
+import time
+from google.appengine.api import apiproxy_stub_map, memcache
+
+# The profiler, the users API and the trace encoding are only imported once a
+# request is traced, so that importing this module doesn't slow down cold
+# starts.
+
+# Requests are profiled at this rate, e.g. 0.01 for one in a hundred, and
+# when an admin sends the _TRACE_HEADER header. Off by default.
+_SAMPLE_RATE_VARIABLE = 'RELAY_PROFILE_SAMPLE_RATE'
+_TRACE_HEADER = 'HTTP_X_RELAY_PROFILE'
+# Traces of all instances share a ring buffer of this many slots in memcache.
+_RING_SIZE = 100
+_MEMCACHE_PREFIX = 'Trace/'
+_COUNTER_KEY = 'next'
+_MEMCACHE_TTL = 24 * 60 * 60
+# Functions in the profile summary, by cumulative time.
+_PROFILE_LINES = 40
+
+_sampleRate = float(os.environ.get(_SAMPLE_RATE_VARIABLE) or 0)
+_local = threading.local()
+_hooksLock = threading.Lock()
+_hooksInstalled = [False]
+
+def _Size(message):
+  try:
+    return message.ByteSize()
+  except Exception:
+    return None
+
+def _PreCallHook(service, call, request, response, rpc):
+  if rpc is not None and getattr(_local, 'rpcs', None) is not None:
+    rpc.traceStartTime = time.time()
+
+def _PostCallHook(service, call, request, response, rpc, error):
+  rpcs = getattr(_local, 'rpcs', None)
+  start = getattr(rpc, 'traceStartTime', None)
+  if rpcs is None or start is None:
+    return
+  rpcs.append({
+    'service': service,
+    'call': call,
+    'url': request.url() if service == 'urlfetch' else None,
+    'start_ms': (start - _local.start) * 1000,
+    'end_ms': (time.time() - _local.start) * 1000,
+    'request_bytes': _Size(request),
+    'response_bytes': _Size(response),
+    'error': None if error is None else str(error),
+  })
+
+def _InstallRpcHooks():
+  # The hooks are only installed once the first request is traced, so that
+  # RPCs don't pay for them while tracing is off.
+  with _hooksLock:
+    if _hooksInstalled[0]:
+      return
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'profiling', _PreCallHook)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'profiling', _PostCallHook)
+    _hooksInstalled[0] = True
+
+def _ShouldTrace(environ):
+  if _sampleRate and random.random() < _sampleRate:
+    return True
+  if not environ.get(_TRACE_HEADER):
+    return False
+  from google.appengine.api import users
+  return users.is_current_user_admin()
+
+def _Summarize(profile):
+  import pstats
+  import StringIO
+  output = StringIO.StringIO()
+  pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(
+      _PROFILE_LINES)
+  return output.getvalue()
+
+class Traces(object):
+  @staticmethod
+  def _Store(trace):
+    traceId = memcache.incr(_MEMCACHE_PREFIX + _COUNTER_KEY, initial_value=0)
+    if traceId is None:
+      return
+    trace['id'] = traceId
+    slot = traceId % _RING_SIZE
+    summary = dict((key, value) for key, value in trace.iteritems()
+                   if key not in ('profile', 'rpcs'))
+    summary['rpcCount'] = len(trace['rpcs'])
+    import zlib
+    memcache.set_multi({
+      'summary/%d' % slot: summary,
+      'data/%d' % slot: zlib.compress(json.dumps(trace)),
+    }, time=_MEMCACHE_TTL, key_prefix=_MEMCACHE_PREFIX)
+
+  @staticmethod
+  def List():
+    # Returns the summaries of the stored traces, newest first.
+    summaries = memcache.get_multi(['summary/%d' % slot
+                                    for slot in xrange(_RING_SIZE)],
+                                   key_prefix=_MEMCACHE_PREFIX)
+    return sorted(summaries.itervalues(), key=lambda summary: summary['id'],
+                  reverse=True)
+
+  @staticmethod
+  def Get(traceId):
+    # Returns the trace as JSON, or None if it has been overwritten.
+    data = memcache.get('%sdata/%d' % (_MEMCACHE_PREFIX, traceId % _RING_SIZE))
+    if data is None:
+      return None
+    import zlib
+    data = zlib.decompress(data)
+    if json.loads(data).get('id') != traceId:
+      return None
+    return data
+
+class Middleware(object):
+  # Records a cProfile summary and a timeline of the datastore, memcache,
+  # taskqueue and urlfetch RPCs of sampled requests. Requests that aren't
+  # sampled go straight to the app.
+
+  def __init__(self, app):
+    self._app = app
+
+  def __call__(self, environ, start_response):
+    if not _ShouldTrace(environ):
+      return self._app(environ, start_response)
+    _InstallRpcHooks()
+    status = []
+
+    def StartResponse(responseStatus, headers, exc_info=None):
+      status.append(responseStatus)
+      return start_response(responseStatus, headers, exc_info)
+
+    import cProfile
+    profile = cProfile.Profile()
+    _local.rpcs = []
+    _local.start = time.time()
+    try:
+      return profile.runcall(self._app, environ, StartResponse)
+    finally:
+      trace = {
+        'method': environ.get('REQUEST_METHOD'),
+        'path': environ.get('PATH_INFO'),
+        'start': _local.start,
+        'duration_ms': (time.time() - _local.start) * 1000,
+        'status': status[-1] if status else None,
+        'rpcs': _local.rpcs,
+      }
+      _local.rpcs = None
+      trace['profile'] = _Summarize(profile)
+      Traces._Store(trace)
@@ -1,86 +1,408 @@
 import json
 import logging
+import threading
+import time
 import urllib
-from google.appengine.api import urlfetch
+from google.appengine.api import memcache
+import http_client
+from http_client import HttpClient
+from stats import Stats
 from value_store import ValueStore
 
 _CLIENT_ID = None
 _CLIENT_SECRET = None
 _REFRESH_TOKEN = None
+# Credentials of additional senders, as (client id, client secret, refresh
+# token) triples. Messages are spread over all senders, so that throughput
+# isn't capped by the quota of one OAuth client. Like the ones above, the
+# credentials are stored on first use, after which a triple can be replaced
+# by None.
+_EXTRA_CREDENTIALS = []
 
 _OAUTH_TOKEN_URL = 'https://accounts.google.com//o/oauth2/token'
 _PUSH_MESSAGE_URL = 'https://www.googleapis.com/gcm_for_chrome/v1/messages'
 
-class PushMessagingService(object):
-  def __init__(self):
-    self._value_store = ValueStore('PushMessagingToken', False)
+_TOKEN_NAMESPACE = 'PushMessagingToken'
+# Access tokens are refreshed this many seconds before they actually expire so
+# that requests never race against the expiration.
+_TOKEN_REFRESH_MARGIN = 5 * 60
+# Used when the token endpoint doesn't tell us the lifetime of a token.
+_DEFAULT_TOKEN_LIFETIME = 60 * 60
+# Only one instance refreshes the token at a time. Others keep using the old
+# token while it's still valid, or wait for the refreshed one.
+_TOKEN_REFRESH_LOCK_TTL = 30
+_TOKEN_REFRESH_WAIT = 0.1
+_TOKEN_REFRESH_MAX_WAITS = 20
+# A sender is taken out of the pool for a while when it can't get an access
+# token, when its token is still rejected after a refresh, or after this many
+# consecutive failed sends. The pause doubles while it keeps failing.
+_SENDER_FAILURE_THRESHOLD = 10
+_SENDER_MIN_PAUSE = 30
+_SENDER_MAX_PAUSE = 10 * 60
+
+class _AccessTokenCache(object):
+  # Access token cache of one sender, shared by all PushMessagingService
+  # instances in the process. Lookups go through instance memory, memcache and
+  # the datastore in that order.
+
+  def __init__(self, namespace, credentials):
+    # |credentials| returns the credentials configured in code, if any.
+    self._namespace = namespace
+    self._credentials = credentials
+    self._memcache_key = '%s/AccessToken' % namespace
+    self._lock_key = '%s/RefreshLock' % namespace
+    self._lock = threading.Lock()
     self._access_token = None
-  
-  def _RenewAccessToken(self):
-    client_id, client_secret, refresh_token = _CLIENT_ID, _CLIENT_SECRET, _REFRESH_TOKEN
-    if _CLIENT_ID:
-      self._value_store.Set('ClientId', _CLIENT_ID)
-      self._value_store.Set('ClientSecret', _CLIENT_SECRET)
-      self._value_store.Set('RefreshToken', _REFRESH_TOKEN)
-    else:
-      client_id, client_secret, refresh_token = self._value_store.Get('ClientId'), self._value_store.Get('ClientSecret'), self._value_store.Get('RefreshToken')
+    self._expires_at = 0
+    self._credentials_saved = False
+
+  def _ValueStore(self):
+    return ValueStore(self._namespace, False)
+
+  @staticmethod
+  def _IsFresh(token, now):
+    return (token is not None and
+        token['expires_at'] - _TOKEN_REFRESH_MARGIN > now)
+
+  @staticmethod
+  def _IsUsable(token, now):
+    return token is not None and token['expires_at'] > now
+
+  @staticmethod
+  def _Parse(value):
+    if isinstance(value, dict) and value.get('access_token'):
+      return {
+        'access_token': value['access_token'],
+        'expires_at': value.get('expires_at', 0),
+      }
+    return None
+
+  def _Remember(self, token):
+    self._access_token = token['access_token']
+    self._expires_at = token['expires_at']
+
+  def _Cached(self):
+    if self._access_token is None:
+      return None
+    return {'access_token': self._access_token, 'expires_at': self._expires_at}
 
+  def Get(self):
+    now = time.time()
+    token = self._Cached()
+    if self._IsFresh(token, now):
+      return token['access_token']
+
+    with self._lock:
+      token = self._Cached()
+      if self._IsFresh(token, now):
+        return token['access_token']
+
+      shared = self._Parse(memcache.get(self._memcache_key))
+      if shared is None:
+        shared = self._Parse(self._ValueStore().Get('AccessToken'))
+        if self._IsUsable(shared, now):
+          memcache.set(self._memcache_key, shared,
+                       time=int(shared['expires_at'] - now))
+      if self._IsUsable(shared, now):
+        self._Remember(shared)
+      if self._IsFresh(shared, now):
+        return shared['access_token']
+
+      return self._RefreshLocked(self._Cached())
+
+  def Invalidate(self, access_token):
+    # Called when the push messaging API rejects |access_token|.
+    with self._lock:
+      if self._access_token != access_token:
+        # Someone else has already refreshed the token.
+        return self._access_token
+      self._access_token = None
+      self._expires_at = 0
+      shared = self._Parse(memcache.get(self._memcache_key))
+      if shared is not None and shared['access_token'] == access_token:
+        memcache.delete(self._memcache_key)
+      return self._RefreshLocked(None)
+
+  def _RefreshLocked(self, stale):
+    if not memcache.add(self._lock_key, 1, time=_TOKEN_REFRESH_LOCK_TTL):
+      # Another instance is refreshing the token.
+      now = time.time()
+      if self._IsUsable(stale, now):
+        return stale['access_token']
+      for _ in xrange(_TOKEN_REFRESH_MAX_WAITS):
+        time.sleep(_TOKEN_REFRESH_WAIT)
+        shared = self._Parse(memcache.get(self._memcache_key))
+        if self._IsUsable(shared, time.time()):
+          self._Remember(shared)
+          return shared['access_token']
+      logging.warning('Timed out waiting for the access token to be ' +
+                      'refreshed by another instance.')
+
+    try:
+      token = self._Refresh()
+    finally:
+      memcache.delete(self._lock_key)
+    if token is None:
+      return None
+    self._Remember(token)
+    return token['access_token']
+
+  def _GetCredentials(self, value_store):
+    names = ['ClientId', 'ClientSecret', 'RefreshToken']
+    credentials = self._credentials()
+    if not credentials or not credentials[0]:
+      return tuple(value_store.GetMulti(names))
+
+    # Persist credentials configured in code so that later versions can run
+    # without them, but only when they are different from the stored ones.
+    credentials = tuple(credentials)
+    if not self._credentials_saved:
+      stored = value_store.GetMulti(names)
+      changed = dict((name, value) for name, value, old_value in
+                     zip(names, credentials, stored) if value != old_value)
+      if changed:
+        value_store.SetMulti(changed)
+      self._credentials_saved = True
+    return credentials
+
+  def _Refresh(self):
+    value_store = self._ValueStore()
+    client_id, client_secret, refresh_token = self._GetCredentials(value_store)
     if not client_id or not client_secret or not refresh_token:
       logging.error('Failed to get client ID.')
       return None
 
-    result = urlfetch.fetch(url=_OAUTH_TOKEN_URL,
-                            payload=urllib.urlencode({
-                              'client_id': client_id,
-                              'client_secret': client_secret,
-                              'refresh_token': refresh_token,
-                              'grant_type': 'refresh_token',
-                            }),
-                            method='POST',
-                            headers={
-                              'Content-Type': 'application/x-www-form-urlencoded'
-                            })
+    try:
+      result = HttpClient.FetchAsync(http_client.OAUTH, _OAUTH_TOKEN_URL,
+          method='POST',
+          payload=urllib.urlencode({
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'refresh_token': refresh_token,
+            'grant_type': 'refresh_token',
+          }),
+          headers={
+            'Content-Type': 'application/x-www-form-urlencoded'
+          }).get_result()
+    except http_client.Error as e:
+      logging.error('Failed to get the access token: %s' % e)
+      return None
     if result.status_code != 200:
       logging.error('Failed to get the access token. Status: %s. Response: %s' %
                     (result.status_code, result.content))
       return None
 
-    result_json = json.loads(result.content)
+    try:
+      result_json = json.loads(result.content)
+      expires_in = int(result_json.get('expires_in', _DEFAULT_TOKEN_LIFETIME))
+    except ValueError:
+      logging.error('Invalid access token response: %s' % result.content)
+      return None
     access_token = result_json.get('access_token')
-    if access_token:
-      self._value_store.Set('AccessToken', access_token)
-      self._access_token = access_token
-    return access_token
+    if not access_token:
+      return None
+
+    token = {
+      'access_token': access_token,
+      'expires_at': time.time() + expires_in,
+    }
+    future = value_store.SetAsync('AccessToken', token)
+    memcache.set(self._memcache_key, token, time=expires_in)
+    future.get_result()
+    return token
+
+class _Sender(object):
+  # One set of credentials with its access token and health.
+
+  def __init__(self, index):
+    self.name = 'sender%d' % index
+    # The first sender keeps the namespace from before there was a pool.
+    namespace = _TOKEN_NAMESPACE if index == 0 else '%s/%d' % (
+        _TOKEN_NAMESPACE, index)
+    self.tokenCache = _AccessTokenCache(namespace,
+                                        lambda: _Sender._Credentials(index))
+    self._lock = threading.Lock()
+    self._failures = 0
+    self._pause = _SENDER_MIN_PAUSE
+    self.pausedUntil = 0
+
+  @staticmethod
+  def _Credentials(index):
+    if index == 0:
+      return (_CLIENT_ID, _CLIENT_SECRET, _REFRESH_TOKEN)
+    return _EXTRA_CREDENTIALS[index - 1]
+
+  def IsHealthy(self, now):
+    return self.pausedUntil <= now
+
+  def Record(self, statuses):
+    # Counts the outcome of sends by this sender. Rejected credentials are
+    # handled by Pause().
+    successes = sum(1 for status in statuses
+                    if status is not None and 200 <= status < 300)
+    failures = sum(1 for status in statuses
+                   if status is None or status == 429 or status >= 500)
+    Stats.Count('push.%s.sent' % self.name, successes)
+    Stats.Count('push.%s.failed' % self.name, failures)
+    with self._lock:
+      if successes:
+        self._failures = 0
+        self._pause = _SENDER_MIN_PAUSE
+      self._failures += failures
+      if self._failures < _SENDER_FAILURE_THRESHOLD:
+        return
+    self.Pause('%s consecutive failures' % _SENDER_FAILURE_THRESHOLD)
+
+  def Pause(self, reason):
+    with self._lock:
+      self._failures = 0
+      self.pausedUntil = time.time() + self._pause
+      pause = self._pause
+      self._pause = min(_SENDER_MAX_PAUSE, self._pause * 2)
+    logging.warning('Push messaging %s paused for %ss: %s.' %
+                    (self.name, pause, reason))
+    Stats.Count('push.%s.paused' % self.name)
+
+class _SenderPool(object):
+  # Senders shared by all PushMessagingService instances in the process.
+  # Health is tracked per instance.
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._senders = []
+    self._next = 0
+
+  def Senders(self):
+    with self._lock:
+      while len(self._senders) < 1 + len(_EXTRA_CREDENTIALS):
+        self._senders.append(_Sender(len(self._senders)))
+      return list(self._senders)
+
+  def Pick(self, excluded):
+    # Returns the healthy senders not in |excluded|, starting from a
+    # different one each time so that small batches are spread too. If none
+    # is healthy, returns the one that will recover first.
+    candidates = [sender for sender in self.Senders()
+                  if sender not in excluded]
+    if not candidates:
+      return []
+    now = time.time()
+    healthy = [sender for sender in candidates if sender.IsHealthy(now)]
+    if not healthy:
+      return [min(candidates, key=lambda sender: sender.pausedUntil)]
+    with self._lock:
+      start = self._next % len(healthy)
+      self._next += 1
+    return healthy[start:] + healthy[:start]
 
-  def _GetAccessToken(self):
-    if self._access_token:
-      return self._access_token
+_senderPool = _SenderPool()
 
-    self._access_token = self._value_store.Get('AccessToken')
-    if self._access_token:
-      return self._access_token
+class PushMessagingService(object):
+  def __init__(self, pool=None):
+    self._pool = pool or _senderPool
 
-    return self._RenewAccessToken()
+  def WarmUp(self):
+    # Loads or refreshes the access tokens ahead of the first send. Returns
+    # whether any sender has one.
+    return any([sender.tokenCache.Get() is not None
+                for sender in self._pool.Senders()])
 
   def SendMessage(self, channelId, subchannelId=0, payload=''):
-    status = self._SendMessageInternal(channelId, subchannelId, payload)
-
-  def _SendMessageInternal(self, channelId, subchannelId, payload, retry=True):
-    result = urlfetch.fetch(url=_PUSH_MESSAGE_URL,
-                            payload=json.dumps({
-                              'channelId': channelId,
-                              'subchannelId': subchannelId,
-                              'payload': payload,
-                            }),
-                            method='POST',
-                            headers={
-                              'Content-Type': 'application/json',
-                              'Authorization': 'Bearer ' + self._GetAccessToken(),
-                            })
-    if (result.status_code == 401 or result.status_code == 403) and retry:
-      self._RenewAccessToken()
-      self._SendMessageInternal(channelId, subchannelId, payload, retry = False)
-    elif result.status_code < 200 or result.status_code >= 300:
+    return self.SendMessages([(channelId, subchannelId, payload)])[0]
+
+  def SendMessages(self, messages):
+    # |messages| is a list of (channelId, subchannelId, payload) tuples. They
+    # are spread over the senders and sent concurrently, up to the limit of
+    # the GCM endpoint in HttpClient. Messages a sender can't send because of
+    # its credentials fail over to the other senders. Returns the status code
+    # for each message, or None if it couldn't be sent at all.
+    statuses = [None] * len(messages)
+    pending = range(len(messages))
+    excluded = set()
+    while pending:
+      senders = self._pool.Pick(excluded)
+      if not senders:
+        break
+      # Senders without messages are left out, so that they don't refresh
+      # their access tokens for nothing.
+      shards = [(sender, pending[offset::len(senders)])
+                for offset, sender in enumerate(senders)
+                if offset < len(pending)]
+      pending = []
+      for sender, indexes in self._SendShards(messages, shards, statuses):
+        excluded.add(sender)
+        pending.extend(indexes)
+    if pending:
+      logging.warning('Push messaging: no sender could send %s message(s).' %
+                      len(pending))
+    return statuses
+
+  def _SendShards(self, messages, shards, statuses):
+    # Sends the messages of each (sender, indexes) shard. Returns the shards
+    # of messages that were rejected because of the sender's credentials.
+    started = []
+    rejectedShards = []
+    for sender, indexes in shards:
+      access_token = sender.tokenCache.Get()
+      if access_token is None:
+        sender.Pause('no access token')
+        rejectedShards.append((sender, indexes))
+        continue
+      started.append((sender, indexes, access_token,
+                      self._StartSends(messages, indexes, access_token)))
+
+    for sender, indexes, access_token, fetches in started:
+      self._WaitForSends(sender, indexes, fetches, statuses)
+      rejected = [index for index in indexes
+                  if statuses[index] == 401 or statuses[index] == 403]
+      if rejected:
+        access_token = sender.tokenCache.Invalidate(access_token)
+        if access_token is not None:
+          self._WaitForSends(sender, rejected,
+              self._StartSends(messages, rejected, access_token), statuses)
+          rejected = [index for index in rejected
+                      if statuses[index] == 401 or statuses[index] == 403]
+      sender.Record([statuses[index] for index in indexes])
+      if rejected:
+        sender.Pause('credentials rejected')
+        rejectedShards.append((sender, rejected))
+    return rejectedShards
+
+  def _StartSends(self, messages, indexes, access_token):
+    return [self._StartSend(messages[index], access_token)
+            for index in indexes]
+
+  def _WaitForSends(self, sender, indexes, fetches, statuses):
+    for index, fetch in zip(indexes, fetches):
+      statuses[index] = None
+      self._WaitForSend(sender, index, fetch, statuses)
+
+  def _StartSend(self, message, access_token):
+    channelId, subchannelId, payload = message
+    return HttpClient.FetchAsync(http_client.GCM, _PUSH_MESSAGE_URL,
+                                 method='POST',
+                                 payload=json.dumps({
+                                   'channelId': channelId,
+                                   'subchannelId': subchannelId,
+                                   'payload': payload,
+                                 }),
+                                 headers={
+                                   'Content-Type': 'application/json',
+                                   'Authorization': 'Bearer ' + access_token,
+                                 })
+
+  def _WaitForSend(self, sender, index, fetch, statuses):
+    try:
+      result = fetch.get_result()
+    except http_client.Error as e:
+      Stats.Count('push.status.error')
+      Stats.Count('push.%s.status.error' % sender.name)
+      logging.warning('Push messaging failed: %s' % e)
+      return
+    Stats.Count('push.status.%d' % result.status_code)
+    Stats.Count('push.%s.status.%d' % (sender.name, result.status_code))
+    statuses[index] = result.status_code
+    if ((result.status_code < 200 or result.status_code >= 300) and
+        result.status_code != 401 and result.status_code != 403):
       logging.warning('Push messaging failed with status %s and response %s' %
                       (result.status_code, result.content))
-    return result.status_code
@@ -0,0 +1,282 @@
+import json
+import logging
+import random
+import threading
+import time
+from google.appengine.api import memcache, taskqueue
+from stats import Stats
+
+# Messages are queued in a pull queue and sent in batches by a worker, which
+# is triggered through a push queue. See queue.yaml.
+_OUTBOX_QUEUE = 'push-outbox'
+_WORKER_QUEUE = 'push-worker'
+_WORKER_URL = '/tasks/push'
+# At most one worker task is scheduled per interval. Messages queued during the
+# interval are sent together when it ends.
+_BATCH_INTERVAL = 1
+# A batch is sent in waves of at most 10 messages, the GCM limit of requests
+# in flight in http_client.py, and each wave may take up to the 10 second GCM
+# deadline. Messages rejected because of an expired access token are sent
+# again after refreshing it, which takes up to another 10 seconds. The lease
+# covers the worst case of a batch, 3 waves sent twice plus a refresh, with
+# room for a failover to another sender, so that the messages aren't leased
+# by another worker while they're still being sent.
+_BATCH_SIZE = 30
+_LEASE_SECONDS = 180
+# The worker stops leasing new batches after this many seconds and schedules
+# another worker instead.
+_WORKER_TIME_BUDGET = 60
+# Failed messages are queued again after an exponential backoff, randomized
+# between half and all of it.
+_MIN_BACKOFF_SECONDS = 2
+_MAX_BACKOFF_SECONDS = 5 * 60
+_MAX_DELIVERY_ATTEMPTS = 10
+# Each instance may resend this many messages per first attempt, plus a small
+# steady allowance so that retries progress when there's no new traffic.
+# Retries beyond the budget are put back into the queue without being sent.
+_RETRY_BUDGET_RATIO = 0.2
+_RETRY_BUDGET_PER_SECOND = 1
+_RETRY_BUDGET_MAX = 100
+# Sending stops for a while after this many consecutive transient failures.
+# Then a few messages are sent to probe whether GCM has recovered, and the
+# pause doubles every time the probe fails.
+_CIRCUIT_FAILURE_THRESHOLD = 20
+_CIRCUIT_MIN_OPEN_SECONDS = 30
+_CIRCUIT_MAX_OPEN_SECONDS = 5 * 60
+_CIRCUIT_PROBE_SIZE = 5
+_CIRCUIT_MEMCACHE_KEY = 'PushCircuit/openUntil'
+
+class _RetryBudget(object):
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._tokens = float(_RETRY_BUDGET_MAX)
+    self._updatedAt = time.time()
+
+  def Deposit(self, firstAttempts):
+    with self._lock:
+      self._Refill()
+      self._tokens = min(_RETRY_BUDGET_MAX,
+                         self._tokens + firstAttempts * _RETRY_BUDGET_RATIO)
+
+  def Withdraw(self, retries):
+    # Returns how many of |retries| may be sent now.
+    with self._lock:
+      self._Refill()
+      granted = min(retries, int(self._tokens))
+      self._tokens -= granted
+      return granted
+
+  def _Refill(self):
+    now = time.time()
+    self._tokens = min(_RETRY_BUDGET_MAX, self._tokens +
+                       (now - self._updatedAt) * _RETRY_BUDGET_PER_SECOND)
+    self._updatedAt = now
+
+class _CircuitBreaker(object):
+  # The open state is shared with other instances through memcache.
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._failures = 0
+    self._openUntil = 0
+    self._openSeconds = _CIRCUIT_MIN_OPEN_SECONDS
+    self._probing = False
+
+  def OpenUntil(self):
+    # Returns the time until which sends are suspended, or None. Once that
+    # time has passed, the next batch is a probe.
+    shared = memcache.get(_CIRCUIT_MEMCACHE_KEY)
+    with self._lock:
+      if shared is not None and shared > self._openUntil:
+        self._openUntil = shared
+      if self._openUntil > time.time():
+        return self._openUntil
+      if self._openUntil:
+        self._openUntil = 0
+        self._probing = True
+    return None
+
+  def BatchSize(self):
+    with self._lock:
+      return _CIRCUIT_PROBE_SIZE if self._probing else _BATCH_SIZE
+
+  def Record(self, successes, failures):
+    # Returns True if the circuit opened.
+    with self._lock:
+      if successes:
+        self._failures = 0
+        self._probing = False
+        self._openSeconds = _CIRCUIT_MIN_OPEN_SECONDS
+      self._failures += failures
+      if not failures or (not self._probing and
+                          self._failures < _CIRCUIT_FAILURE_THRESHOLD):
+        return False
+      if self._probing:
+        self._openSeconds = min(_CIRCUIT_MAX_OPEN_SECONDS,
+                                self._openSeconds * 2)
+      self._probing = False
+      self._failures = 0
+      self._openUntil = time.time() + self._openSeconds
+      openUntil, openSeconds = self._openUntil, self._openSeconds
+    logging.warning('Push messaging suspended for %ss after repeated '
+                    'failures.' % openSeconds)
+    Stats.Count('push.circuitOpened')
+    memcache.set(_CIRCUIT_MEMCACHE_KEY, openUntil, time=openSeconds)
+    return True
+
+_retryBudget = _RetryBudget()
+_circuitBreaker = _CircuitBreaker()
+_failureHandler = [None]
+
+class PushQueue(object):
+  @staticmethod
+  def Enqueue(channelId, subchannelId=0, payload=''):
+    PushQueue.EnqueueMulti([(channelId, subchannelId, payload)])
+
+  @staticmethod
+  def EnqueueMulti(messages, contexts=None):
+    # |messages| is a list of (channelId, subchannelId, payload) tuples.
+    # |contexts|, if given, has a JSON-serializable value for each message,
+    # which is passed to the failure handler if the message is dropped.
+    if not messages:
+      return
+    contexts = contexts or [None] * len(messages)
+    tasks = [PushQueue._Task(message, context, 0)
+             for message, context in zip(messages, contexts)]
+    rpcs = [taskqueue.Queue(_OUTBOX_QUEUE).add_async(tasks),
+            PushQueue._ScheduleWorkerAsync(0)]
+    # Let any exception from adding the message itself propagate.
+    rpcs[0].get_result()
+    PushQueue._WaitForWorker(rpcs[1])
+
+  @staticmethod
+  def SetFailureHandler(handler):
+    # |handler| is called with the contexts of messages that are dropped,
+    # either because they are rejected or because they ran out of attempts.
+    _failureHandler[0] = handler
+
+  @staticmethod
+  def _Task(message, context, attempts, countdown=0):
+    channelId, subchannelId, payload = message
+    body = {
+      'channelId': channelId,
+      'subchannelId': subchannelId,
+      'payload': payload,
+      'attempts': attempts,
+    }
+    if context is not None:
+      body['context'] = context
+    return taskqueue.Task(method='PULL', payload=json.dumps(body),
+                          countdown=countdown)
+
+  @staticmethod
+  def _ScheduleWorkerAsync(delay):
+    eta = time.time() + delay
+    slot = int(eta) // _BATCH_INTERVAL + 1
+    countdown = max(0, slot * _BATCH_INTERVAL - time.time())
+    task = taskqueue.Task(url=_WORKER_URL, name='push-worker-%d' % slot,
+                          countdown=countdown)
+    return taskqueue.Queue(_WORKER_QUEUE).add_async(task)
+
+  @staticmethod
+  def _WaitForWorker(rpc):
+    try:
+      rpc.get_result()
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      # Another message has already scheduled the worker for this interval.
+      pass
+
+  @staticmethod
+  def _Backoff(attempts):
+    delay = min(_MAX_BACKOFF_SECONDS, _MIN_BACKOFF_SECONDS * 2 ** attempts)
+    return random.uniform(delay / 2.0, delay)
+
+  @staticmethod
+  def _IsPermanentFailure(status):
+    return (status is not None and 400 <= status < 500 and
+            status not in (401, 403, 429))
+
+  @staticmethod
+  def Process():
+    # Sends all queued messages. Returns the number of messages delivered.
+    # The GCM client is only loaded by the worker, not by handlers that
+    # enqueue messages.
+    from push_messaging import PushMessagingService
+    queue = taskqueue.Queue(_OUTBOX_QUEUE)
+    svc = PushMessagingService()
+    deadline = time.time() + _WORKER_TIME_BUDGET
+    delivered = 0
+    retryDelay = None
+    while True:
+      openUntil = _circuitBreaker.OpenUntil()
+      if openUntil is not None:
+        # The messages stay in the queue until GCM is probed again.
+        delay = openUntil - time.time()
+        retryDelay = delay if retryDelay is None else min(retryDelay, delay)
+        break
+      batchSize = _circuitBreaker.BatchSize()
+      tasks = queue.lease_tasks(_LEASE_SECONDS, batchSize)
+      if not tasks:
+        break
+      items = []
+      for task in tasks:
+        body = json.loads(task.payload)
+        items.append((task, (body['channelId'], body['subchannelId'],
+                             body['payload']),
+                      body.get('context'), body.get('attempts', 0)))
+
+      retries = [item for item in items if item[3] > 0]
+      granted = _retryBudget.Withdraw(len(retries))
+      deferred = retries[granted:]
+      sending = [item for item in items if item[3] == 0] + retries[:granted]
+      _retryBudget.Deposit(len(sending) - granted)
+      statuses = svc.SendMessages([message for _, message, _, _ in sending])
+
+      requeued = []
+      dropped = []
+      successes = failures = 0
+      for (task, message, context, attempts), status in zip(sending, statuses):
+        if status is not None and 200 <= status < 300:
+          delivered += 1
+          successes += 1
+        elif (PushQueue._IsPermanentFailure(status) or
+              attempts + 1 >= _MAX_DELIVERY_ATTEMPTS):
+          logging.error(('Dropping push message after %s attempt(s), ' +
+                         'last status %s: %s') %
+                        (attempts + 1, status, task.payload))
+          dropped.append(context)
+        else:
+          failures += 1
+          requeued.append((message, context, attempts + 1))
+      requeued.extend((message, context, attempts)
+                      for _, message, context, attempts in deferred)
+      Stats.Count('push.delivered', successes)
+      Stats.Count('push.retried', len(requeued) - len(deferred))
+      Stats.Count('push.deferred', len(deferred))
+      Stats.Count('push.dropped', len(dropped))
+
+      if requeued:
+        retryTasks = []
+        for message, context, attempts in requeued:
+          delay = PushQueue._Backoff(attempts - 1)
+          retryTasks.append(PushQueue._Task(message, context, attempts, delay))
+          retryDelay = delay if retryDelay is None else min(retryDelay, delay)
+        # Added before the leased tasks are deleted, so that a message is
+        # never lost.
+        queue.add(retryTasks)
+      queue.delete_tasks(tasks)
+      dropped = [context for context in dropped if context is not None]
+      if dropped and _failureHandler[0] is not None:
+        _failureHandler[0](dropped)
+
+      if _circuitBreaker.Record(successes, failures):
+        continue
+      if len(tasks) < batchSize:
+        break
+      if time.time() > deadline:
+        PushQueue._WaitForWorker(PushQueue._ScheduleWorkerAsync(0))
+        break
+
+    if retryDelay is not None:
+      PushQueue._WaitForWorker(PushQueue._ScheduleWorkerAsync(retryDelay))
+    return delivered
@@ -0,0 +1,58 @@
+import math
+import threading
+import time
+from google.appengine.api import memcache
+from lru_cache import LruCache
+
+_MEMCACHE_PREFIX = 'RateLimit/'
+# Buckets of this many keys are kept in instance memory.
+_LOCAL_CACHE_SIZE = 10000
+
+class RateLimiter(object):
+  # A token bucket shared by all instances. The bucket holds up to |burst|
+  # tokens and is refilled by |burst| tokens every |burst| / |rate| seconds,
+  # which is counted in memcache. Instances take |lease| tokens at a time into
+  # a local bucket, so only every |lease|-th request reaches memcache, and
+  # remember a drained bucket until it's refilled, so that shed requests don't
+  # reach memcache at all. Requests are admitted when memcache is unavailable.
+
+  def __init__(self, name, rate, burst, lease=1):
+    self._name = name
+    self._window = float(burst) / rate
+    self._burst = burst
+    self._lease = lease
+    self._lock = threading.Lock()
+    # Maps keys to [tokens, windowEnd, drained] of the current window.
+    self._buckets = LruCache(_LOCAL_CACHE_SIZE, self._window)
+
+  def Admit(self, key=''):
+    # Takes one token of |key|'s bucket. Returns False if it's drained.
+    now = time.time()
+    window = int(now // self._window)
+    windowEnd = (window + 1) * self._window
+    with self._lock:
+      bucket = self._buckets.Get(key)
+      if bucket is not None and bucket[1] == windowEnd:
+        if bucket[2]:
+          return False
+        if bucket[0] > 0:
+          bucket[0] -= 1
+          return True
+
+    memcacheKey = '%s%s/%s/%d' % (_MEMCACHE_PREFIX, self._name, key, window)
+    taken = memcache.incr(memcacheKey, delta=self._lease)
+    if taken is None:
+      # The first lease of the window creates the counter, which expires with
+      # the window. incr() would create it without an expiration.
+      if memcache.add(memcacheKey, self._lease,
+                      time=int(math.ceil(windowEnd - now)) + 1):
+        taken = self._lease
+      else:
+        taken = memcache.incr(memcacheKey, delta=self._lease)
+    if taken is None:
+      return True
+    granted = min(self._lease, self._burst - (taken - self._lease))
+    with self._lock:
+      self._buckets.Set(key, [max(0, granted - 1), windowEnd, granted <= 0],
+                        ttl=windowEnd - now)
+    return granted > 0
@@ -0,0 +1,160 @@
+import binascii
+import json
+import time
+from google.appengine.api import memcache, taskqueue
+from channels import Channels
+import models
+from push_queue import PushQueue
+from stats import Stats
+
+# Change notifications for the same channel arriving within this many seconds
+# are folded into one state update and at most one push message. Set to 0 to
+# relay every notification as it arrives.
+COALESCE_WINDOW_SECONDS = 2
+_COALESCE_QUEUE = 'coalesce'
+_COALESCE_URL = '/tasks/coalesce'
+# Extra time given to notifications that are still being handled when the
+# window closes.
+_COALESCE_GRACE_SECONDS = 1
+_COALESCE_CAS_RETRIES = 5
+# Stands for notifications without a change id, since memcache can't tell a
+# stored None from a miss.
+_NO_CHANGE_ID = -1
+
+class Relay(object):
+  @staticmethod
+  def Sync(channelId, token):
+    Relay.NotifySynced(Channels.Sync(channelId, token))
+
+  @staticmethod
+  def NotifySynced(targets):
+    # |targets| is a list of (channelId, gcmChannelId).
+    PushQueue.EnqueueMulti([(gcmChannel, 0, json.dumps({
+      'channelId': channelId,
+      'sync': True,
+    })) for channelId, gcmChannel in targets])
+
+  @staticmethod
+  def Change(channelId, token, largestChangeId):
+    # The token is verified here, so that only its hash is passed on to the
+    # coalescing task. Channels.UpdateChangeId() verifies it again when it
+    # writes the channel.
+    tokenHash = models.HashToken(token)
+    if not Channels.VerifyToken(channelId, tokenHash):
+      Stats.Count('notify.unknownChannel')
+      return
+    if COALESCE_WINDOW_SECONDS > 0 and Relay._Coalesce(
+        channelId, tokenHash, largestChangeId):
+      Stats.Count('notify.coalesced')
+      return
+    Relay._UpdateChangeId(channelId, tokenHash, largestChangeId, 1)
+
+  @staticmethod
+  def _UpdateChangeId(channelId, tokenHash, largestChangeId, notifications):
+    # All channels sharing the Drive watch are notified.
+    targets = Channels.UpdateChangeId(channelId, tokenHash, largestChangeId,
+                                      notifications)
+    Relay._NotifyChanges([
+        (targetId, gcmChannel, largestChangeId, firstChangeId, count)
+        for targetId, gcmChannel, firstChangeId, count in targets])
+
+  @staticmethod
+  def _NotifyChanges(changes):
+    # |changes| is a list of (channelId, gcmChannelId, largestChangeId,
+    # firstChangeId, notificationCount). The client only has to fetch changes
+    # from |firstChangeId| to |largestChangeId|, which arrived in
+    # |notificationCount| notifications since it last bound the channel.
+    PushQueue.EnqueueMulti([(gcmChannel, 0, json.dumps({
+      'largestChangeId': largestChangeId,
+      'firstChangeId': firstChangeId,
+      'notificationCount': count,
+      'channelId': channelId,
+    })) for channelId, gcmChannel, largestChangeId, firstChangeId, count
+        in changes], [{
+      'channelId': channelId,
+      'largestChangeId': largestChangeId,
+    } for channelId, _, largestChangeId, _, _ in changes])
+
+  @staticmethod
+  def DeliveryFailed(contexts):
+    # Called by PushQueue with the contexts of change notifications that
+    # couldn't be delivered. Their channels take notifications again, and
+    # changes suppressed while they were pending are relayed now.
+    changes = []
+    for context in contexts:
+      result = Channels.RollBack(context['channelId'],
+                                 context['largestChangeId'])
+      if result is not None:
+        changes.append((context['channelId'],) + result)
+    Relay._NotifyChanges(changes)
+
+  @staticmethod
+  def _CoalesceKey(channelId, tokenHash, window):
+    # Notifications with a different token never reach the same channel state,
+    # so they don't share a window.
+    return 'coalesce/%s/%s/%d' % (channelId, binascii.hexlify(tokenHash),
+                                  window)
+
+  @staticmethod
+  def _Coalesce(channelId, tokenHash, largestChangeId):
+    # Records |largestChangeId| in the current window of the channel, which
+    # holds the largest change id and the number of notifications so far.
+    # Redelivered notifications aren't counted. Returns False if the
+    # notification has to be handled right away instead.
+    now = time.time()
+    window = int(now // COALESCE_WINDOW_SECONDS)
+    key = Relay._CoalesceKey(channelId, tokenHash, window)
+    windowEnd = (window + 1) * COALESCE_WINDOW_SECONDS
+    # Long enough for the flush task to find the window.
+    expiration = COALESCE_WINDOW_SECONDS + 60
+
+    if largestChangeId is None:
+      largestChangeId = _NO_CHANGE_ID
+    client = memcache.Client()
+    for _ in xrange(_COALESCE_CAS_RETRIES):
+      pending = client.gets(key)
+      if pending is None:
+        if client.add(key, (largestChangeId, 1), time=expiration):
+          # The first notification of the window schedules the flush.
+          try:
+            taskqueue.Queue(_COALESCE_QUEUE).add(taskqueue.Task(
+                url=_COALESCE_URL,
+                name='coalesce-%s-%d' % (channelId, window),
+                countdown=windowEnd - now + _COALESCE_GRACE_SECONDS,
+                params={
+                  'channelId': channelId,
+                  'tokenHash': binascii.hexlify(tokenHash),
+                  'window': window,
+                  'largestChangeId': largestChangeId,
+                }))
+          except (taskqueue.TaskAlreadyExistsError,
+                  taskqueue.TombstonedTaskError):
+            pass
+          except taskqueue.Error:
+            client.delete(key)
+            return False
+          return True
+        continue
+      pendingChangeId, notifications = pending
+      if pendingChangeId == largestChangeId:
+        return True
+      if client.cas(key, (max(pendingChangeId, largestChangeId),
+                          notifications + 1), time=expiration):
+        return True
+    return False
+
+  @staticmethod
+  def FlushChanges(channelId, tokenHash, window, largestChangeId):
+    # Called once the window is over. |largestChangeId| is the id carried by
+    # the notification that opened the window, in case memcache lost the
+    # window.
+    pending = memcache.get(Relay._CoalesceKey(channelId, tokenHash, window))
+    notifications = 1
+    if pending is not None:
+      largestChangeId = max(largestChangeId, pending[0])
+      notifications = pending[1]
+    if largestChangeId == _NO_CHANGE_ID:
+      largestChangeId = None
+    Relay._UpdateChangeId(channelId, tokenHash, largestChangeId, notifications)
+
+PushQueue.SetFailureHandler(Relay.DeliveryFailed)
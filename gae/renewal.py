@@ -0,0 +1,65 @@
+import json
+import random
+import time
+from datetime import datetime, timedelta
+from google.appengine.api import taskqueue
+from channels import Channels
+from push_queue import PushQueue
+
+# Drive watches can only be created with the user's credentials, which the
+# relay doesn't keep. Instead, clients are asked to renew their channels ahead
+# of expiration, at a random time between these two leads so that renewals
+# don't bunch up.
+_MIN_LEAD = timedelta(minutes=10)
+_MAX_LEAD = timedelta(minutes=40)
+# Each run of the scheduler looks at channels expiring this far from now.
+RENEWAL_LEAD = _MAX_LEAD
+# How far each run of the scheduler looks ahead. Must match cron.yaml.
+_SCHEDULE_PERIOD = timedelta(hours=1)
+_RENEWAL_QUEUE = 'renewal'
+_RENEWAL_URL = '/tasks/renew'
+# Renewal requests are sent in batches, one per bucket of this many seconds.
+_BUCKET_SECONDS = 60
+_PAGE_SIZE = 500
+_MAX_TASKS_PER_ADD = 100
+
+class RenewalScheduler(object):
+  @staticmethod
+  def Schedule(windowStart, cursor=None, deadline=None):
+    # Schedules renewal requests for channels expiring within _SCHEDULE_PERIOD
+    # after |windowStart|, which should be RENEWAL_LEAD from now. Returns the
+    # number of scheduled requests and a cursor to resume from, or None when
+    # done.
+    scheduled = 0
+    more = True
+    while more and (deadline is None or time.time() < deadline):
+      channels, cursor, more = Channels.FindExpiring(windowStart,
+          windowStart + _SCHEDULE_PERIOD, _PAGE_SIZE, cursor)
+      buckets = {}
+      for channelId, gcmChannelId, expiration in channels:
+        lead = random.uniform(_MIN_LEAD.total_seconds(),
+                              _MAX_LEAD.total_seconds())
+        sendAt = time.mktime(expiration.timetuple()) - lead
+        buckets.setdefault(int(sendAt // _BUCKET_SECONDS), []).append(
+            (channelId, gcmChannelId))
+      tasks = [taskqueue.Task(url=_RENEWAL_URL,
+                              payload=json.dumps(targets),
+                              eta=RenewalScheduler._Eta(bucket))
+               for bucket, targets in buckets.iteritems()]
+      for i in xrange(0, len(tasks), _MAX_TASKS_PER_ADD):
+        taskqueue.Queue(_RENEWAL_QUEUE).add(tasks[i:i + _MAX_TASKS_PER_ADD])
+      scheduled += len(channels)
+    return scheduled, (cursor if more else None)
+
+  @staticmethod
+  def _Eta(bucket):
+    return datetime.utcfromtimestamp(
+        max(bucket * _BUCKET_SECONDS, time.time()))
+
+  @staticmethod
+  def RequestRenewal(targets):
+    # |targets| is a list of (channelId, gcmChannelId).
+    PushQueue.EnqueueMulti([(gcmChannelId, 0, json.dumps({
+      'channelId': channelId,
+      'renew': True,
+    })) for channelId, gcmChannelId in targets])
@@ -0,0 +1,165 @@
+import bisect
+import threading
+import time
+from google.appengine.api import apiproxy_stub_map, memcache
+
+# Metrics are aggregated in instance memory and added to the counters in
+# memcache at most once per _FLUSH_INTERVAL seconds, at the end of a request.
+_FLUSH_INTERVAL = 10
+_MEMCACHE_PREFIX = 'stats/'
+_NAMES_KEY = 'names'
+_CAS_RETRIES = 5
+# Upper bounds of the latency histogram buckets, in milliseconds.
+_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+_OVERFLOW_BUCKET = 'inf'
+# Paths of requests timed per handler. Others are timed as 'other'.
+_HANDLER_PATHS = set(['/notify', '/bind', '/status', '/outbox', '/cron',
+                      '/cron/renew', '/tasks/push', '/tasks/coalesce',
+                      '/tasks/renew', '/_ah/warmup'])
+
+_lock = threading.Lock()
+_counters = {}
+_lastFlush = [time.time()]
+# Metric names this instance has already registered in memcache.
+_registered = set()
+
+class Stats(object):
+  @staticmethod
+  def Count(name, delta=1):
+    with _lock:
+      _counters[name] = _counters.get(name, 0) + delta
+
+  @staticmethod
+  def Record(name, seconds):
+    # Adds a latency sample to the histogram |name|.
+    milliseconds = seconds * 1000
+    index = bisect.bisect_left(_BUCKETS, milliseconds)
+    bucket = _BUCKETS[index] if index < len(_BUCKETS) else _OVERFLOW_BUCKET
+    with _lock:
+      for counter, delta in (('%s#%s' % (name, bucket), 1),
+                             (name + '#count', 1),
+                             (name + '#sum_ms', int(milliseconds))):
+        _counters[counter] = _counters.get(counter, 0) + delta
+
+  @staticmethod
+  def Flush(force=False):
+    with _lock:
+      if not _counters or (not force and
+                           time.time() - _lastFlush[0] < _FLUSH_INTERVAL):
+        return
+      deltas = dict(_counters)
+      _counters.clear()
+      _lastFlush[0] = time.time()
+    Stats._Register([name for name in deltas if name not in _registered])
+    memcache.offset_multi(deltas, key_prefix=_MEMCACHE_PREFIX,
+                          initial_value=0)
+
+  @staticmethod
+  def _Register(names):
+    if not names:
+      return
+    client = memcache.Client()
+    for _ in xrange(_CAS_RETRIES):
+      registered = client.gets(_MEMCACHE_PREFIX + _NAMES_KEY)
+      if registered is None:
+        if client.add(_MEMCACHE_PREFIX + _NAMES_KEY, sorted(names)):
+          break
+        continue
+      missing = set(names) - set(registered)
+      if not missing or client.cas(_MEMCACHE_PREFIX + _NAMES_KEY,
+                                   sorted(missing.union(registered))):
+        break
+    _registered.update(names)
+
+  @staticmethod
+  def GetAll():
+    # Returns the counters aggregated across instances, with latency
+    # histograms summarized.
+    names = memcache.get(_MEMCACHE_PREFIX + _NAMES_KEY) or []
+    values = memcache.get_multi(names, key_prefix=_MEMCACHE_PREFIX)
+    counters = {}
+    histograms = {}
+    for name, value in values.iteritems():
+      if '#' not in name:
+        counters[name] = value
+        continue
+      histogram, field = name.split('#', 1)
+      histograms.setdefault(histogram, {})[field] = value
+    return {
+      'counters': counters,
+      'latencies': dict((name, Stats._Summarize(histogram))
+                        for name, histogram in histograms.iteritems()),
+    }
+
+  @staticmethod
+  def _Summarize(histogram):
+    count = histogram.get('count', 0)
+    summary = {
+      'count': count,
+      'mean_ms': histogram.get('sum_ms', 0) / float(count) if count else 0,
+    }
+    for label, fraction in (('p50_ms', 0.5), ('p90_ms', 0.9),
+                            ('p99_ms', 0.99)):
+      # The upper bound of the bucket holding the percentile.
+      seen = 0
+      summary[label] = None
+      for bucket in _BUCKETS + [_OVERFLOW_BUCKET]:
+        seen += histogram.get(str(bucket), 0)
+        if count and seen >= fraction * count:
+          summary[label] = bucket
+          break
+    return summary
+
+  @staticmethod
+  def Reset():
+    with _lock:
+      _counters.clear()
+    names = memcache.get(_MEMCACHE_PREFIX + _NAMES_KEY) or []
+    memcache.delete_multi(names, key_prefix=_MEMCACHE_PREFIX)
+
+def _UrlFetchTarget(request):
+  url = request.url()
+  if '//accounts.google.com/' in url:
+    return 'oauth'
+  if '/gcm_for_chrome/' in url:
+    return 'gcm'
+  if '//www.googleapis.com/drive/' in url:
+    return 'drive'
+  return 'other'
+
+def _PreCallHook(service, call, request, response, rpc):
+  if rpc is not None:
+    rpc.statsStartTime = time.time()
+
+def _PostCallHook(service, call, request, response, rpc, error):
+  start = getattr(rpc, 'statsStartTime', None)
+  if start is None:
+    return
+  if service == 'urlfetch':
+    call = _UrlFetchTarget(request)
+  Stats.Record('rpc.%s.%s' % (service, call), time.time() - start)
+  if error is not None:
+    Stats.Count('rpc.%s.%s.errors' % (service, call))
+
+def InstallRpcHooks():
+  # Times every datastore, memcache, taskqueue and urlfetch RPC.
+  apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+      'stats', _PreCallHook)
+  apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+      'stats', _PostCallHook)
+
+class Middleware(object):
+  # Times each request by handler and flushes the metrics when they're due.
+
+  def __init__(self, app):
+    self._app = app
+
+  def __call__(self, environ, start_response):
+    path = environ.get('PATH_INFO', '')
+    name = 'handler.%s' % (path if path in _HANDLER_PATHS else 'other')
+    start = time.time()
+    try:
+      return self._app(environ, start_response)
+    finally:
+      Stats.Record(name, time.time() - start)
+      Stats.Flush()
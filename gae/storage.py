@@ -0,0 +1,320 @@
+import contextlib
+import os
+import Queue
+import threading
+from datetime import datetime
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+from lru_cache import LruCache
+
+# Selects the backend used by Channels and ValueStore, see CreateBackend().
+_BACKEND_VARIABLE = 'RELAY_STORAGE'
+_DEFAULT_BACKEND = 'ndb'
+# The in-memory backend evicts the least recently used entities beyond this.
+_MEMORY_CAPACITY = 1000000
+_SQLITE_POOL_SIZE = 4
+# SQLite limits the number of parameters of a statement to 999.
+_SQLITE_MAX_PARAMETERS = 500
+_EPOCH = datetime(1970, 1, 1)
+
+_backend = [None]
+_backendLock = threading.Lock()
+
+def CreateBackend(spec):
+  # |spec| is 'ndb', 'memory' or 'sqlite:<path>'.
+  if spec == 'ndb':
+    return NdbBackend()
+  if spec == 'memory':
+    return MemoryBackend()
+  if spec.startswith('sqlite:'):
+    return SqliteBackend(spec.split(':', 1)[1])
+  raise ValueError('Unknown storage backend: %s' % spec)
+
+def GetBackend():
+  if _backend[0] is None:
+    with _backendLock:
+      if _backend[0] is None:
+        _backend[0] = CreateBackend(
+            os.environ.get(_BACKEND_VARIABLE, _DEFAULT_BACKEND))
+  return _backend[0]
+
+def SetBackend(backend):
+  _backend[0] = backend
+
+# Entities are ndb models with string ids in all backends. Entities with an
+# expiration property can be queried by it.
+class Backend(object):
+  def GetMulti(self, modelClass, ids):
+    return [future.get_result()
+            for future in self.GetMultiAsync(modelClass, ids)]
+
+  def Get(self, modelClass, id):
+    return self.GetMulti(modelClass, [id])[0]
+
+  def PutMulti(self, entities):
+    for future in self.PutMultiAsync(entities):
+      future.get_result()
+
+  def DeleteMulti(self, modelClass, ids):
+    for future in self.DeleteMultiAsync(modelClass, ids):
+      future.get_result()
+
+class NdbBackend(Backend):
+  def GetMultiAsync(self, modelClass, ids):
+    return ndb.get_multi_async([ndb.Key(modelClass, id) for id in ids])
+
+  def PutMultiAsync(self, entities):
+    return ndb.put_multi_async(entities)
+
+  def DeleteMultiAsync(self, modelClass, ids):
+    return ndb.delete_multi_async([ndb.Key(modelClass, id) for id in ids])
+
+  def RunInTransaction(self, callback, xg=False):
+    # Raises TransactionFailedError on contention.
+    return ndb.transaction(callback, retries=0, xg=xg)
+
+  def QueryByExpiration(self, modelClass, start, end, pageSize, cursor=None,
+                        keysOnly=False):
+    # Returns a page of entities, or ids with |keysOnly|, expiring at or
+    # after |start| and before |end|, either of which may be None. Also
+    # returns an opaque cursor string for the next page and whether there are
+    # more pages.
+    query = modelClass.query()
+    if start is not None:
+      query = query.filter(modelClass.expiration >= start)
+    if end is not None:
+      query = query.filter(modelClass.expiration < end)
+    results, cursor, more = query.fetch_page(pageSize, keys_only=keysOnly,
+        start_cursor=ndb.Cursor(urlsafe=cursor) if cursor else None)
+    if keysOnly:
+      results = [key.id() for key in results]
+    return results, cursor.urlsafe() if cursor else None, more
+
+  def CountByExpiration(self, modelClass, end, limit):
+    return modelClass.query(modelClass.expiration < end).count(
+        limit, keys_only=True)
+
+def _Resolved(value):
+  future = ndb.Future()
+  future.set_result(value)
+  return future
+
+def _ToSeconds(value):
+  return None if value is None else (value - _EPOCH).total_seconds()
+
+class _LocalBackend(Backend):
+  # Keeps serialized entities in process-local storage. Writes and
+  # transactions are serialized within the process, so only one process
+  # should use the same storage at a time. Writes made in a transaction are
+  # applied in one batch when it completes.
+
+  def __init__(self):
+    self._lock = threading.RLock()
+    self._local = threading.local()
+
+  def _Pending(self):
+    return getattr(self._local, 'pending', None)
+
+  def GetMultiAsync(self, modelClass, ids):
+    kind = modelClass._get_kind()
+    pending = self._Pending() or {}
+    stored = self._Read(kind, [id for id in ids if (kind, id) not in pending])
+    entities = []
+    for id in ids:
+      if (kind, id) in pending:
+        data = pending[(kind, id)][2]
+      else:
+        data = stored.get(id)
+      entities.append(_Resolved(None if data is None else
+          ndb.model_from_protobuf(entity_pb.EntityProto(data))))
+    return entities
+
+  def PutMultiAsync(self, entities):
+    rows = []
+    for entity in entities:
+      entity._pre_put_hook()
+      rows.append((entity._get_kind(), entity.key.id(),
+                   _ToSeconds(getattr(entity, 'expiration', None)),
+                   ndb.model_to_protobuf(entity).SerializeToString()))
+    self._Apply(rows)
+    return [_Resolved(entity.key) for entity in entities]
+
+  def DeleteMultiAsync(self, modelClass, ids):
+    kind = modelClass._get_kind()
+    self._Apply([(kind, id, None, None) for id in ids])
+    return [_Resolved(None) for _ in ids]
+
+  def _Apply(self, rows):
+    # |rows| are (kind, id, expiration, data), with data None for deletions.
+    pending = self._Pending()
+    if pending is not None:
+      for row in rows:
+        pending[row[:2]] = row
+      return
+    with self._lock:
+      self._Write(rows)
+
+  def RunInTransaction(self, callback, xg=False):
+    with self._lock:
+      if self._Pending() is not None:
+        return callback()
+      self._local.pending = {}
+      try:
+        result = callback()
+        self._Write(self._local.pending.values())
+      finally:
+        self._local.pending = None
+      return result
+
+  def QueryByExpiration(self, modelClass, start, end, pageSize, cursor=None,
+                        keysOnly=False):
+    # Results are ordered by expiration and id. The cursor is the position of
+    # the last result.
+    after = None
+    if cursor:
+      expiration, id = cursor.split(' ', 1)
+      after = (float(expiration), id)
+    rows = self._Scan(modelClass._get_kind(), _ToSeconds(start),
+                      _ToSeconds(end), after, pageSize + 1)
+    more = len(rows) > pageSize
+    rows = rows[:pageSize]
+    cursor = None
+    if rows:
+      cursor = '%r %s' % (rows[-1][0], rows[-1][1])
+    if keysOnly:
+      results = [id for _, id, _ in rows]
+    else:
+      results = [ndb.model_from_protobuf(entity_pb.EntityProto(data))
+                 for _, _, data in rows]
+    return results, cursor, more
+
+  def CountByExpiration(self, modelClass, end, limit):
+    return self._Count(modelClass._get_kind(), _ToSeconds(end), limit)
+
+class MemoryBackend(_LocalBackend):
+  # Entities live in a thread-safe LRU in instance memory. Queries scan all
+  # entities of the kind, which is fine for development and benchmarks.
+
+  def __init__(self, capacity=_MEMORY_CAPACITY):
+    _LocalBackend.__init__(self)
+    self._entities = LruCache(capacity, float('inf'))
+
+  def _Read(self, kind, ids):
+    stored = {}
+    for id in ids:
+      row = self._entities.Get((kind, id))
+      if row is not None:
+        stored[id] = row[1]
+    return stored
+
+  def _Write(self, rows):
+    for kind, id, expiration, data in rows:
+      if data is None:
+        self._entities.Delete((kind, id))
+      else:
+        self._entities.Set((kind, id), (expiration, data))
+
+  def _Matching(self, kind, start, end):
+    return sorted((expiration, id, data)
+                  for (rowKind, id), (expiration, data)
+                  in self._entities.Items()
+                  if rowKind == kind and expiration is not None and
+                     (start is None or expiration >= start) and
+                     (end is None or expiration < end))
+
+  def _Scan(self, kind, start, end, after, limit):
+    rows = self._Matching(kind, start, end)
+    if after is not None:
+      rows = [row for row in rows if row[:2] > after]
+    return rows[:limit]
+
+  def _Count(self, kind, end, limit):
+    return min(len(self._Matching(kind, None, end)), limit)
+
+class SqliteBackend(_LocalBackend):
+  # Stores entities in one table indexed by kind, expiration and id.
+  # Connections are pooled and shared between threads.
+
+  def __init__(self, path, poolSize=_SQLITE_POOL_SIZE):
+    # The sqlite3 module isn't available on App Engine.
+    import sqlite3
+    _LocalBackend.__init__(self)
+    if path == ':memory:':
+      # Every connection would get its own database.
+      poolSize = 1
+    self._pool = Queue.Queue()
+    for _ in xrange(poolSize):
+      connection = sqlite3.connect(path, check_same_thread=False)
+      connection.text_factory = str
+      if path != ':memory:':
+        # Lets readers proceed while a write is in progress.
+        connection.execute('PRAGMA journal_mode=WAL')
+      self._pool.put(connection)
+    with self._Connection() as connection:
+      connection.execute('CREATE TABLE IF NOT EXISTS entities ('
+                         'kind TEXT NOT NULL, id TEXT NOT NULL, '
+                         'expiration REAL, data BLOB NOT NULL, '
+                         'PRIMARY KEY (kind, id))')
+      connection.execute('CREATE INDEX IF NOT EXISTS entities_expiration '
+                         'ON entities (kind, expiration, id)')
+      connection.commit()
+
+  @contextlib.contextmanager
+  def _Connection(self):
+    connection = self._pool.get()
+    try:
+      yield connection
+    finally:
+      self._pool.put(connection)
+
+  def _Read(self, kind, ids):
+    stored = {}
+    with self._Connection() as connection:
+      for i in xrange(0, len(ids), _SQLITE_MAX_PARAMETERS):
+        batch = ids[i:i + _SQLITE_MAX_PARAMETERS]
+        stored.update((id, str(data)) for id, data in connection.execute(
+            'SELECT id, data FROM entities WHERE kind = ? AND id IN (%s)' %
+            ','.join('?' * len(batch)), [kind] + batch))
+    return stored
+
+  def _Write(self, rows):
+    puts = [(kind, id, expiration, buffer(data))
+            for kind, id, expiration, data in rows if data is not None]
+    deletes = [(kind, id) for kind, id, _, data in rows if data is None]
+    with self._Connection() as connection:
+      try:
+        if puts:
+          connection.executemany('INSERT OR REPLACE INTO entities '
+                                 'VALUES (?, ?, ?, ?)', puts)
+        if deletes:
+          connection.executemany('DELETE FROM entities '
+                                 'WHERE kind = ? AND id = ?', deletes)
+        connection.commit()
+      except:
+        connection.rollback()
+        raise
+
+  def _Scan(self, kind, start, end, after, limit):
+    conditions = ['kind = ?', 'expiration IS NOT NULL']
+    parameters = [kind]
+    if start is not None:
+      conditions.append('expiration >= ?')
+      parameters.append(start)
+    if end is not None:
+      conditions.append('expiration < ?')
+      parameters.append(end)
+    if after is not None:
+      conditions.append('(expiration > ? OR (expiration = ? AND id > ?))')
+      parameters.extend([after[0], after[0], after[1]])
+    with self._Connection() as connection:
+      return [(expiration, id, str(data)) for expiration, id, data in
+              connection.execute('SELECT expiration, id, data FROM entities '
+                                 'WHERE %s ORDER BY expiration, id LIMIT ?' %
+                                 ' AND '.join(conditions),
+                                 parameters + [limit])]
+
+  def _Count(self, kind, end, limit):
+    with self._Connection() as connection:
+      return connection.execute('SELECT COUNT(*) FROM (SELECT 1 FROM entities '
+                                'WHERE kind = ? AND expiration < ? LIMIT ?)',
+                                [kind, end, limit]).fetchone()[0]
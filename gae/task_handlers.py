@@ -0,0 +1,116 @@
+import binascii
+import json
+import logging
+import time
+import webapp2
+from datetime import datetime
+from google.appengine.api import taskqueue
+from channels import Channels
+from push_queue import PushQueue
+from relay import Relay
+from renewal import RenewalScheduler, RENEWAL_LEAD
+
+# Cron jobs and tasks may run for 10 minutes. Leave some time for scheduling
+# the continuation of a cron job.
+_CRON_TIME_BUDGET = 8 * 60
+_CRON_QUEUE = 'cron'
+# Counting the remaining backlog stops at this many channels.
+_CLEANUP_BACKLOG_COUNT_LIMIT = 10000
+
+# POST /tasks/push
+# Sends messages queued by PushQueue.Enqueue() in batches.
+class PushWorkerHandler(webapp2.RequestHandler):
+  def post(self):
+    self.response.status = 200
+    delivered = PushQueue.Process()
+    if delivered:
+      logging.info('Push worker: Delivered %s message(s).' % delivered)
+
+# GET /cron/renew
+# Asks clients to renew channels that will expire soon.
+class RenewalCronHandler(webapp2.RequestHandler):
+  def get(self):
+    start = time.time()
+    self.response.status = 200
+    self.response.headers['Content-Type'] = 'text/plain'
+    try:
+      windowStart = float(self.request.get('windowStart',
+          start + RENEWAL_LEAD.total_seconds()))
+    except ValueError:
+      self.response.status = 400
+      return
+    cursor = self.request.get('cursor') or None
+
+    scheduled, cursor = RenewalScheduler.Schedule(
+        datetime.fromtimestamp(windowStart), cursor,
+        start + _CRON_TIME_BUDGET)
+    if cursor is not None:
+      taskqueue.add(queue_name=_CRON_QUEUE, url='/cron/renew',
+                    method='GET', params={
+                      'windowStart': repr(windowStart),
+                      'cursor': cursor,
+                    })
+    message = 'Cron job: Scheduled renewal of %s channel(s).' % scheduled
+    logging.info(message)
+    self.response.write(message)
+
+# POST /tasks/renew
+# Sends a batch of renewal requests scheduled by RenewalCronHandler.
+class RenewalHandler(webapp2.RequestHandler):
+  def post(self):
+    self.response.status = 200
+    try:
+      targets = json.loads(self.request.body)
+    except ValueError:
+      return
+    RenewalScheduler.RequestRenewal(targets)
+
+# POST /tasks/coalesce
+# Relays the change notifications collected in one coalescing window.
+class CoalesceHandler(webapp2.RequestHandler):
+  def post(self):
+    self.response.status = 200
+    try:
+      window = int(self.request.get('window'))
+      largestChangeId = int(self.request.get('largestChangeId'))
+      tokenHash = binascii.unhexlify(self.request.get('tokenHash'))
+    except (ValueError, TypeError):
+      return
+    Relay.FlushChanges(self.request.get('channelId'), tokenHash, window,
+                       largestChangeId)
+
+# GET /cron
+# Deletes expired channels. When it runs out of time, the rest of the backlog
+# is deleted by a continuation task with the same cutoff.
+class CronHandler(webapp2.RequestHandler):
+  def get(self):
+    start = time.time()
+    self.response.status = 200
+    self.response.headers['Content-Type'] = 'text/plain'
+    try:
+      cutoffTime = float(self.request.get('cutoff', start))
+      cutoff = datetime.fromtimestamp(cutoffTime)
+    except ValueError:
+      self.response.status = 400
+      return
+    cursor = self.request.get('cursor') or None
+
+    deleted, cursor = Channels.Cleanup(cutoff, cursor,
+                                       start + _CRON_TIME_BUDGET)
+    elapsed = time.time() - start
+    remaining = 0
+    if cursor is not None:
+      taskqueue.add(queue_name=_CRON_QUEUE, url='/cron', method='GET',
+                    params={
+                      'cutoff': repr(cutoffTime),
+                      'cursor': cursor,
+                    })
+      remaining = Channels.CountExpired(cutoff, _CLEANUP_BACKLOG_COUNT_LIMIT)
+
+    rate = deleted / elapsed if elapsed > 0 else 0
+    if remaining >= _CLEANUP_BACKLOG_COUNT_LIMIT:
+      remaining = '%s+' % remaining
+    message = ('Cron job: Removed %s expired channel(s) in %.1fs (%.1f/s), ' +
+               '%s remaining.') % (deleted, elapsed, rate, remaining)
+    logging.info(message)
+    self.response.write(message)
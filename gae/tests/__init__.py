@@ -0,0 +1,8 @@
+"""Unit tests for the relay backend.
+
+Run from gae/:
+  python -m unittest discover -s tests -t . -p '*_test.py'
+
+Tests that need the App Engine SDK are skipped unless it's on the path, e.g.
+PYTHONPATH=/path/to/google_appengine.
+"""
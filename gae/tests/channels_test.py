@@ -0,0 +1,192 @@
+import unittest
+from datetime import datetime, timedelta
+
+try:
+  from google.appengine.ext import testbed
+  import channels
+  from channels import Channels
+  import models
+  import storage
+except ImportError:
+  testbed = None
+
+_ACCOUNT = 'permission-1'
+
+@unittest.skipIf(testbed is None, 'The App Engine SDK is not on the path.')
+class ChannelsTest(unittest.TestCase):
+  # Channels are stored in the in-memory backend, with the memcache stub.
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.setup_env(app_id='relay-test', overwrite=True)
+    self.testbed.init_memcache_stub()
+    storage.SetBackend(storage.MemoryBackend())
+    channels._cache.Clear()
+    channels._deadCache.Clear()
+    self.expiration = datetime.now() + timedelta(hours=2)
+
+  def tearDown(self):
+    storage.SetBackend(None)
+    self.testbed.deactivate()
+
+  def _Add(self, channelId, gcmChannelId, largestChangeId, accountId=None,
+           previousChannelId=None):
+    synced = Channels.Add(channelId, 'token-' + channelId, gcmChannelId,
+                          self.expiration, largestChangeId, accountId,
+                          previousChannelId)
+    if not synced:
+      Channels.Sync(channelId, 'token-' + channelId)
+
+  def _Attach(self, channelId, gcmChannelId, largestChangeId,
+              previousChannelId=None, minExpiration=None):
+    return Channels.Attach(_ACCOUNT, channelId, gcmChannelId, largestChangeId,
+                           minExpiration or datetime.now(), previousChannelId)
+
+  def _Change(self, channelId, largestChangeId):
+    return Channels.UpdateChangeId(
+        channelId, models.HashToken('token-' + channelId), largestChangeId)
+
+  def _Stored(self, channelId):
+    return storage.GetBackend().Get(models.RelayChannel, channelId)
+
+  def _State(self, channelId):
+    # Returns (changeId, status, firstChangeId, notificationCount).
+    channel = self._Stored(channelId)
+    return (channel.changeIdAndStatus >> models.CHANGE_ID_SHIFT,
+            channel.changeIdAndStatus & models.STATUS_MASK,
+            channel.firstChangeId, channel.notificationCount)
+
+  def testCoalescedNotificationsAreCounted(self):
+    self._Add('a', 'gcm-1', 10)
+    self.assertEqual(Channels.UpdateChangeId(
+        'a', models.HashToken('token-a'), 14, notifications=3),
+        [('a', 'gcm-1', 11, 3)])
+    self._Change('a', 15)
+    self.assertEqual(self._State('a'), (15, models.STATUS_PENDING, 11, 4))
+
+  def testReplacementInheritsUnacknowledgedChanges(self):
+    self._Add('a', 'gcm-1', 10)
+    self._Change('a', 12)
+    self.assertEqual(self._State('a'), (12, models.STATUS_PENDING, 11, 1))
+    Channels.Add('b', 'token-b', 'gcm-1', self.expiration, 10,
+                 previousChannelId='a')
+    self.assertEqual(self._State('b'), (12, models.STATUS_PENDING, 11, 1))
+
+  def testReplacementAfterAcknowledgingStartsOver(self):
+    self._Add('a', 'gcm-1', 10)
+    self._Change('a', 12)
+    Channels.Add('b', 'token-b', 'gcm-1', self.expiration, 12,
+                 previousChannelId='a')
+    self.assertEqual(self._State('b'), (12, models.STATUS_CREATED, None, 0))
+    Channels.Sync('b', 'token-b')
+    self.assertEqual([target[:2] for target in self._Change('b', 13)],
+                     [('b', 'gcm-1')])
+
+  def testReplacementOfAnotherClientInheritsNothing(self):
+    self._Add('a', 'gcm-1', 10)
+    self._Change('a', 12)
+    Channels.Add('b', 'token-b', 'gcm-2', self.expiration, 10,
+                 previousChannelId='a')
+    self.assertEqual(self._State('b'), (10, models.STATUS_CREATED, None, 0))
+
+  def testAttachSharesWatch(self):
+    self._Add('a', 'gcm-1', 10, _ACCOUNT)
+    expiration, synced = self._Attach('b', 'gcm-2', 10)
+    self.assertEqual(expiration, self.expiration)
+    self.assertTrue(synced)
+    self.assertEqual(self._Stored('a').subscriberIds, ['b'])
+    self.assertEqual(self._Stored('b').watchId, 'a')
+    self.assertEqual([target[:2] for target in self._Change('a', 12)],
+                     [('a', 'gcm-1'), ('b', 'gcm-2')])
+    self.assertEqual(self._State('b'), (12, models.STATUS_PENDING, 11, 1))
+
+  def testAttachBeforeSync(self):
+    Channels.Add('a', 'token-a', 'gcm-1', self.expiration, 10, _ACCOUNT)
+    self.assertFalse(self._Attach('b', 'gcm-2', 10)[1])
+    self.assertEqual(sorted(Channels.Sync('a', 'token-a')),
+                     [('a', 'gcm-1'), ('b', 'gcm-2')])
+
+  def testAttachRejectsExpiringWatch(self):
+    self._Add('a', 'gcm-1', 10, _ACCOUNT)
+    self.assertIsNone(self._Attach(
+        'b', 'gcm-2', 10, minExpiration=self.expiration + timedelta(1)))
+    self.assertEqual(self._Stored('a').subscriberIds, [])
+
+  def testAttachRejectsWatchOfReplacedChannel(self):
+    self._Add('a', 'gcm-1', 10, _ACCOUNT)
+    self.assertIsNone(self._Attach('b', 'gcm-1', 10, previousChannelId='a'))
+    self._Attach('b', 'gcm-2', 10)
+    self.assertIsNone(self._Attach('c', 'gcm-2', 10, previousChannelId='b'))
+    self.assertEqual(self._Stored('a').subscriberIds, ['b'])
+
+  def testAttachLimitsSubscribers(self):
+    self._Add('a', 'gcm-1', 10, _ACCOUNT)
+    for i in xrange(channels._MAX_SUBSCRIBERS):
+      self.assertIsNotNone(self._Attach('b%d' % i, 'gcm-b%d' % i, 10))
+    self.assertIsNone(self._Attach('c', 'gcm-c', 10))
+
+  def testFanOutRequiresToken(self):
+    self._Add('a', 'gcm-1', 10, _ACCOUNT)
+    self._Attach('b', 'gcm-2', 10)
+    self.assertEqual(Channels.UpdateChangeId('a', models.HashToken('wrong'),
+                                             12), [])
+    self.assertEqual(self._State('a'), (10, models.STATUS_READY, None, 0))
+    self.assertEqual(self._State('b'), (10, models.STATUS_READY, None, 0))
+
+  def testFanOutSkipsRemovedSubscribers(self):
+    self._Add('a', 'gcm-1', 10, _ACCOUNT)
+    self._Attach('b', 'gcm-2', 10)
+    self._Attach('c', 'gcm-3', 10)
+    Channels.Remove('b')
+    self.assertEqual([target[:2] for target in self._Change('a', 12)],
+                     [('a', 'gcm-1'), ('c', 'gcm-3')])
+
+  def testOutbox(self):
+    self._Add('a', 'gcm-1', 10)
+    self.assertEqual(Channels.GetOutbox('a'), ([], 0))
+    self._Change('a', 12)
+    self.assertEqual([changeId for changeId, _ in
+                      Channels.GetOutbox('a')[0]], [12])
+    self.assertIsNone(Channels.GetOutbox('missing'))
+
+  def testOutboxOfExpiredChannelIsUnavailable(self):
+    self.expiration = datetime.now() - timedelta(minutes=1)
+    self._Add('a', 'gcm-1', 10)
+    self._Change('a', 12)
+    self.assertIsNone(Channels.GetOutbox('a'))
+
+  def testRetireSubscriber(self):
+    self._Add('a', 'gcm-1', 10, _ACCOUNT)
+    self._Attach('b', 'gcm-2', 10)
+    Channels.Retire('b', 'gcm-2')
+    self.assertIsNone(self._Stored('b'))
+    self.assertTrue(Channels.IsDead('b'))
+    self.assertEqual(self._Stored('a').subscriberIds, [])
+    self.assertEqual([target[:2] for target in self._Change('a', 12)],
+                     [('a', 'gcm-1')])
+
+  def testRetireOwnerWithSubscribers(self):
+    self._Add('a', 'gcm-1', 10, _ACCOUNT)
+    self._Attach('b', 'gcm-2', 10)
+    Channels.Retire('a', 'gcm-1')
+    self.assertIsNone(self._Stored('a').gcmChannelId)
+    self.assertEqual([target[:2] for target in self._Change('a', 12)],
+                     [('b', 'gcm-2')])
+    self.assertEqual(Channels.FindExpiring(None, None, 10)[0],
+                     [('b', 'gcm-2', self.expiration)])
+
+  def testRetireOwner(self):
+    self._Add('a', 'gcm-1', 10, _ACCOUNT)
+    Channels.Retire('a', 'gcm-1')
+    self.assertIsNone(self._Stored('a'))
+    self.assertTrue(Channels.IsDead('a'))
+    self.assertEqual(self._Change('a', 12), [])
+
+  def testRetireIgnoresOtherClients(self):
+    self._Add('a', 'gcm-1', 10)
+    Channels.Retire('a', 'gcm-2')
+    self.assertEqual(self._Stored('a').gcmChannelId, 'gcm-1')
+
+if __name__ == '__main__':
+  unittest.main()
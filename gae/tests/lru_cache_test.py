@@ -0,0 +1,65 @@
+import unittest
+from lru_cache import LruCache
+
+class LruCacheTest(unittest.TestCase):
+  def testGetAndSet(self):
+    cache = LruCache(10, 60)
+    self.assertIsNone(cache.Get('a'))
+    self.assertEqual(cache.Get('a', 'default'), 'default')
+    cache.Set('a', 1)
+    cache.Set('a', 2)
+    self.assertEqual(cache.Get('a'), 2)
+
+  def testFalsyValuesAreCached(self):
+    cache = LruCache(10, 60)
+    cache.Set('a', 0)
+    cache.Set('b', '')
+    self.assertEqual(cache.Get('a', 'default'), 0)
+    self.assertEqual(cache.Get('b', 'default'), '')
+
+  def testEvictsLeastRecentlyUsed(self):
+    cache = LruCache(2, 60)
+    cache.Set('a', 1)
+    cache.Set('b', 2)
+    cache.Get('a')
+    cache.Set('c', 3)
+    self.assertEqual(cache.Get('a'), 1)
+    self.assertIsNone(cache.Get('b'))
+    self.assertEqual(cache.Get('c'), 3)
+
+  def testExpiration(self):
+    cache = LruCache(10, 60)
+    cache.Set('a', 1, ttl=-1)
+    cache.Set('b', 2)
+    self.assertIsNone(cache.Get('a'))
+    self.assertEqual(cache.Get('b'), 2)
+    self.assertEqual(cache.Items(), [('b', 2)])
+
+  def testDelete(self):
+    cache = LruCache(10, 60)
+    for key in 'abc':
+      cache.Set(key, key)
+    cache.Delete('a')
+    cache.Delete('missing')
+    cache.DeleteMulti(['b', 'missing'])
+    self.assertEqual(cache.Items(), [('c', 'c')])
+    cache.Clear()
+    self.assertEqual(cache.Items(), [])
+
+  def testItemsDontCountAsUse(self):
+    cache = LruCache(2, 60)
+    cache.Set('a', 1)
+    cache.Set('b', 2)
+    self.assertEqual(cache.Items(), [('a', 1), ('b', 2)])
+    cache.Set('c', 3)
+    self.assertEqual(cache.Items(), [('b', 2), ('c', 3)])
+
+  def testStats(self):
+    cache = LruCache(10, 60)
+    cache.Set('a', 1)
+    cache.Get('a')
+    cache.Get('b')
+    self.assertEqual(cache.Stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+if __name__ == '__main__':
+  unittest.main()
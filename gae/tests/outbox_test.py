@@ -0,0 +1,63 @@
+import time
+import unittest
+import outbox
+from outbox import Outbox
+
+_NOW = 1400000000
+
+class OutboxTest(unittest.TestCase):
+  def testEmpty(self):
+    self.assertEqual(Outbox.Decode(None), ([], 0))
+    self.assertEqual(Outbox.Decode(''), ([], 0))
+    self.assertIsNone(Outbox.Encode([], 0))
+    self.assertIsNone(Outbox.Trim(None, 10))
+
+  def testRoundTrip(self):
+    entries = [(5, _NOW - 100), (6, _NOW - 100), (300, _NOW - 1),
+               (2 ** 40, _NOW)]
+    data = Outbox.Encode(entries, 3)
+    self.assertEqual(Outbox.Decode(data, _NOW), (entries, 3))
+
+  def testAppend(self):
+    data = None
+    for changeId, offset in [(10, 0), (12, 1), (15, 5)]:
+      data = Outbox.Append(data, changeId, _NOW + offset)
+    self.assertEqual(Outbox.Decode(data, _NOW + 5),
+                     ([(10, _NOW), (12, _NOW + 1), (15, _NOW + 5)], 0))
+
+  def testAppendIgnoresOlderChanges(self):
+    data = Outbox.Append(None, 10, _NOW)
+    self.assertEqual(Outbox.Append(data, 10, _NOW), data)
+    self.assertEqual(Outbox.Append(data, 9, _NOW), data)
+    data = Outbox.Encode([], 20)
+    self.assertEqual(Outbox.Append(data, 20, _NOW), data)
+
+  def testAppendDropsOldestEntries(self):
+    data = None
+    for changeId in xrange(1, outbox._MAX_ENTRIES + 3):
+      data = Outbox.Append(data, changeId, _NOW)
+    entries, droppedUpTo = Outbox.Decode(data, _NOW)
+    self.assertEqual(len(entries), outbox._MAX_ENTRIES)
+    self.assertEqual(entries[0][0], 3)
+    self.assertEqual(droppedUpTo, 2)
+
+  def testExpiredEntriesAreDropped(self):
+    data = Outbox.Encode([(1, _NOW - outbox._TTL - 10),
+                          (2, _NOW - outbox._TTL - 1),
+                          (3, _NOW - outbox._TTL)], 0)
+    self.assertEqual(Outbox.Decode(data, _NOW),
+                     ([(3, _NOW - outbox._TTL)], 2))
+    data = Outbox.Append(data, 4, _NOW + 1)
+    self.assertEqual(Outbox.Decode(data, _NOW + 1), ([(4, _NOW + 1)], 3))
+
+  def testTrim(self):
+    now = int(time.time())
+    data = Outbox.Encode([(5, now), (7, now), (9, now)], 3)
+    self.assertEqual(Outbox.Decode(Outbox.Trim(data, 7), now),
+                     ([(9, now)], 0))
+    self.assertEqual(Outbox.Decode(Outbox.Trim(data, 2), now),
+                     ([(5, now), (7, now), (9, now)], 3))
+    self.assertIsNone(Outbox.Trim(data, 9))
+
+if __name__ == '__main__':
+  unittest.main()
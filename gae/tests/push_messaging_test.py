@@ -0,0 +1,71 @@
+import unittest
+
+try:
+  from push_messaging import PushMessagingService
+except ImportError:
+  PushMessagingService = None
+
+class _FakeTokenCache(object):
+  def __init__(self):
+    self.gets = 0
+
+  def Get(self):
+    self.gets += 1
+    return 'access-token'
+
+class _FakeSender(object):
+  def __init__(self, name):
+    self.name = name
+    self.tokenCache = _FakeTokenCache()
+    self.recorded = []
+
+  def Record(self, statuses):
+    self.recorded.extend(statuses)
+
+  def Pause(self, reason):
+    pass
+
+class _FakePool(object):
+  def __init__(self, senders):
+    self.senders = senders
+
+  def Pick(self, excluded):
+    return [sender for sender in self.senders if sender not in excluded]
+
+def _Service(pool):
+  # Sends complete right away with 200, without HTTP requests.
+  class Service(PushMessagingService):
+    def _StartSend(self, message, access_token):
+      return message
+
+    def _WaitForSend(self, sender, index, fetch, statuses):
+      statuses[index] = 200
+  return Service(pool)
+
+@unittest.skipIf(PushMessagingService is None,
+                 'The App Engine SDK is not on the path.')
+class SendMessagesTest(unittest.TestCase):
+  def testMessagesAreSpreadOverSenders(self):
+    senders = [_FakeSender('sender%d' % i) for i in xrange(3)]
+    statuses = _Service(_FakePool(senders)).SendMessages(
+        [('channel%d' % i, 0, 'payload') for i in xrange(7)])
+    self.assertEqual(statuses, [200] * 7)
+    self.assertEqual([len(sender.recorded) for sender in senders], [3, 2, 2])
+
+  def testSendersWithoutMessagesAreSkipped(self):
+    senders = [_FakeSender('sender%d' % i) for i in xrange(3)]
+    statuses = _Service(_FakePool(senders)).SendMessages(
+        [('channel', 0, 'payload')])
+    self.assertEqual(statuses, [200])
+    self.assertEqual([sender.tokenCache.gets for sender in senders],
+                     [1, 0, 0])
+    self.assertEqual([sender.recorded for sender in senders],
+                     [[200], [], []])
+
+  def testNoMessages(self):
+    senders = [_FakeSender('sender0')]
+    self.assertEqual(_Service(_FakePool(senders)).SendMessages([]), [])
+    self.assertEqual(senders[0].tokenCache.gets, 0)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,154 @@
+import unittest
+from datetime import datetime, timedelta
+
+try:
+  from google.appengine.ext import ndb, testbed
+  import models
+  import storage
+except ImportError:
+  ndb = None
+
+_BASE_TIME = datetime(2014, 1, 1)
+
+class _BackendTests(object):
+  # Tests shared by the local backends. Subclasses implement CreateBackend().
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.setup_env(app_id='relay-test', overwrite=True)
+    self.backend = self.CreateBackend()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def _Channel(self, channelId, minutes=None):
+    return models.RelayChannel(
+        key=ndb.Key(models.RelayChannel, channelId),
+        gcmChannelId='gcm-' + channelId,
+        expiration=(None if minutes is None else
+                    _BASE_TIME + timedelta(minutes=minutes)),
+        changeIdAndStatus=5)
+
+  def testPutAndGet(self):
+    self.backend.PutMulti([self._Channel('a', 1), self._Channel('b')])
+    channel = self.backend.Get(models.RelayChannel, 'a')
+    self.assertEqual(channel.key.id(), 'a')
+    self.assertEqual(channel.gcmChannelId, 'gcm-a')
+    self.assertEqual(channel.expiration, _BASE_TIME + timedelta(minutes=1))
+    self.assertEqual(channel.changeIdAndStatus, 5)
+    self.assertEqual([channel and channel.key.id() for channel in
+                      self.backend.GetMulti(models.RelayChannel,
+                                            ['b', 'missing', 'a'])],
+                     ['b', None, 'a'])
+
+  def testPutReplaces(self):
+    self.backend.PutMulti([self._Channel('a')])
+    channel = self._Channel('a')
+    channel.changeIdAndStatus = 9
+    self.backend.PutMulti([channel])
+    self.assertEqual(
+        self.backend.Get(models.RelayChannel, 'a').changeIdAndStatus, 9)
+
+  def testKindsAreSeparate(self):
+    self.backend.PutMulti([self._Channel('a'), models.AccountWatch(
+        key=ndb.Key(models.AccountWatch, 'b'), channelId='a')])
+    self.assertIsNone(self.backend.Get(models.AccountWatch, 'a'))
+    self.assertIsNone(self.backend.Get(models.RelayChannel, 'b'))
+    self.assertEqual(self.backend.Get(models.AccountWatch, 'b').channelId, 'a')
+
+  def testDelete(self):
+    self.backend.PutMulti([self._Channel('a'), self._Channel('b')])
+    self.backend.DeleteMulti(models.RelayChannel, ['a', 'missing'])
+    self.assertIsNone(self.backend.Get(models.RelayChannel, 'a'))
+    self.assertIsNotNone(self.backend.Get(models.RelayChannel, 'b'))
+
+  def testManyIds(self):
+    ids = ['channel%d' % i for i in xrange(1200)]
+    self.backend.PutMulti([self._Channel(id) for id in ids])
+    self.assertEqual([channel.key.id() for channel in
+                      self.backend.GetMulti(models.RelayChannel, ids)], ids)
+
+  def testTransaction(self):
+    def Txn():
+      self.backend.PutMulti([self._Channel('a')])
+      # Writes of the transaction are visible to its own reads.
+      return self.backend.Get(models.RelayChannel, 'a')
+    self.assertEqual(self.backend.RunInTransaction(Txn).key.id(), 'a')
+    self.assertIsNotNone(self.backend.Get(models.RelayChannel, 'a'))
+
+  def testFailedTransactionIsDiscarded(self):
+    self.backend.PutMulti([self._Channel('a')])
+
+    def Txn():
+      self.backend.PutMulti([self._Channel('b')])
+      self.backend.DeleteMulti(models.RelayChannel, ['a'])
+      raise ValueError()
+    self.assertRaises(ValueError, self.backend.RunInTransaction, Txn)
+    self.assertIsNotNone(self.backend.Get(models.RelayChannel, 'a'))
+    self.assertIsNone(self.backend.Get(models.RelayChannel, 'b'))
+
+  def testQueryByExpiration(self):
+    self.backend.PutMulti([self._Channel('e', 5), self._Channel('b', 2),
+                           self._Channel('c', 2), self._Channel('a', 1),
+                           self._Channel('d', 4), self._Channel('none')])
+    ids = []
+    cursor = None
+    more = True
+    while more:
+      page, cursor, more = self.backend.QueryByExpiration(
+          models.RelayChannel, None, None, 2, cursor, keysOnly=True)
+      self.assertLessEqual(len(page), 2)
+      ids.extend(page)
+    self.assertEqual(ids, ['a', 'b', 'c', 'd', 'e'])
+
+    channels, _, more = self.backend.QueryByExpiration(
+        models.RelayChannel, _BASE_TIME + timedelta(minutes=2),
+        _BASE_TIME + timedelta(minutes=5), 10)
+    self.assertEqual([channel.key.id() for channel in channels],
+                     ['b', 'c', 'd'])
+    self.assertEqual(channels[0].gcmChannelId, 'gcm-b')
+    self.assertFalse(more)
+
+  def testCountByExpiration(self):
+    self.backend.PutMulti([self._Channel(id, minutes) for id, minutes in
+                           [('a', 1), ('b', 2), ('c', 3), ('none', None)]])
+    count = self.backend.CountByExpiration
+    self.assertEqual(count(models.RelayChannel,
+                           _BASE_TIME + timedelta(minutes=3), 10), 2)
+    self.assertEqual(count(models.RelayChannel,
+                           _BASE_TIME + timedelta(minutes=3), 1), 1)
+    self.assertEqual(count(models.AccountWatch,
+                           _BASE_TIME + timedelta(minutes=3), 10), 0)
+
+@unittest.skipIf(ndb is None, 'The App Engine SDK is not on the path.')
+class MemoryBackendTest(_BackendTests, unittest.TestCase):
+  def CreateBackend(self):
+    return storage.MemoryBackend()
+
+  def testEvictsLeastRecentlyUsed(self):
+    backend = storage.MemoryBackend(capacity=2)
+    backend.PutMulti([self._Channel('a'), self._Channel('b')])
+    backend.Get(models.RelayChannel, 'a')
+    backend.PutMulti([self._Channel('c')])
+    self.assertEqual([channel and channel.key.id() for channel in
+                      backend.GetMulti(models.RelayChannel, ['a', 'b', 'c'])],
+                     ['a', None, 'c'])
+
+@unittest.skipIf(ndb is None, 'The App Engine SDK is not on the path.')
+class SqliteBackendTest(_BackendTests, unittest.TestCase):
+  def CreateBackend(self):
+    return storage.SqliteBackend(':memory:')
+
+@unittest.skipIf(ndb is None, 'The App Engine SDK is not on the path.')
+class CreateBackendTest(unittest.TestCase):
+  def testSpecs(self):
+    self.assertIsInstance(storage.CreateBackend('ndb'), storage.NdbBackend)
+    self.assertIsInstance(storage.CreateBackend('memory'),
+                          storage.MemoryBackend)
+    self.assertIsInstance(storage.CreateBackend('sqlite::memory:'),
+                          storage.SqliteBackend)
+    self.assertRaises(ValueError, storage.CreateBackend, 'unknown')
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,24 @@
+import re
+
+# Request validation shared by the handlers. Patterns are compiled when the
+# module is loaded, see warmup.py.
+
+# Note that base64-encoded channel id cannot be longer than 64 characters.
+CHANNEL_ID_BITS = 256
+# math.ceil(256.0 / 8 / 3) * 4 = 44 and the trailing '=' is stripped.
+CHANNEL_ID_REGEX = re.compile(r'^[0-9a-zA-Z-_]{43}$')
+# Note that base64-encoded token cannot be longer than 256 characters.
+CHANNEL_TOKEN_BITS = 1024
+# math.ceil(1024.0 / 8 / 3) * 4 = 172
+CHANNEL_TOKEN_REGEX = re.compile(r'^[0-9a-zA-Z-_]{171}=$')
+
+MAX_REQUEST_BODY_LEN = 256
+# Batch requests carry up to MAX_BATCH_SIZE channels. A batch /bind updates
+# them in one transaction, which can span at most 25 entity groups.
+MAX_BATCH_SIZE = 25
+MAX_BATCH_REQUEST_BODY_LEN = 4096
+
+# Must be consistent with generateClientId() in /js/bg.js
+CLIENT_ID_REGEX = re.compile(r'^[0-9a-zA-Z_]{32}$')
+# <Obfuscated GAIA ID>/<Extension ID>, see BindHandler._isValidGcmChannelId().
+GCM_CHANNEL_ID_REGEX = re.compile(r'\d{1,40}/[a-p]{32}')
@@ -1,6 +1,17 @@
 import json
 import os
 from google.appengine.ext import ndb
+from lru_cache import LruCache
+import storage
+
+# Values are cached in instance memory. Set() updates the cache of the
+# instance it runs on, other instances see the new value within _CACHE_TTL.
+_CACHE_SIZE = 1000
+_CACHE_TTL = 60
+# Cached for keys that don't exist in the datastore.
+_MISSING = object()
+
+_cache = LruCache(_CACHE_SIZE, _CACHE_TTL)
 
 class ValueStore(object):
   class Model(ndb.Model):
@@ -14,22 +25,56 @@ class ValueStore(object):
       self._app_version = os.environ['CURRENT_VERSION_ID'].split('.', 1)[0]
     self._namespace = namespace
 
+  def _GetKeyName(self, key):
+    return '%s@%s/%s' % (self._namespace, self._app_version, key)
+
   def _GetKey(self, key):
-    return ndb.Key(ValueStore.Model,
-                   '%s@%s/%s' % (self._namespace, self._app_version, key))
+    return ndb.Key(ValueStore.Model, self._GetKeyName(key))
 
   def Get(self, key, default_value=None):
-    entity = self._GetKey(key).get()
-    if entity is None:
-      return default_value
-    return json.loads(entity.content)
+    return self.GetAsync(key, default_value).get_result()
+
+  @ndb.tasklet
+  def GetAsync(self, key, default_value=None):
+    values = yield self.GetMultiAsync([key], default_value)
+    raise ndb.Return(values[0])
 
-  def GetMulti(self, keys):
-    pass
+  def GetMulti(self, keys, default_value=None):
+    return self.GetMultiAsync(keys, default_value).get_result()
+
+  @ndb.tasklet
+  def GetMultiAsync(self, keys, default_value=None):
+    # Resolves to a list with the value of each key in |keys|.
+    contents = [_cache.Get(self._GetKeyName(key)) for key in keys]
+    missing = [index for index, content in enumerate(contents)
+               if content is None]
+    if missing:
+      entities = yield storage.GetBackend().GetMultiAsync(ValueStore.Model,
+          [self._GetKeyName(keys[index]) for index in missing])
+      for index, entity in zip(missing, entities):
+        content = _MISSING if entity is None else entity.content
+        _cache.Set(self._GetKeyName(keys[index]), content)
+        contents[index] = content
+    raise ndb.Return([default_value if content is _MISSING else
+                      json.loads(content) for content in contents])
 
   def Set(self, key, value):
-    entity = ValueStore.Model(key=self._GetKey(key),
-                              app_version=self._app_version,
-                              namespace=self._namespace,
-                              content=json.dumps(value))
-    entity.put()
+    self.SetAsync(key, value).get_result()
+
+  def SetAsync(self, key, value):
+    return self.SetMultiAsync({key: value})
+
+  def SetMulti(self, values):
+    self.SetMultiAsync(values).get_result()
+
+  @ndb.tasklet
+  def SetMultiAsync(self, values):
+    # |values| is a dict of keys and values to store.
+    entities = [ValueStore.Model(key=self._GetKey(key),
+                                 app_version=self._app_version,
+                                 namespace=self._namespace,
+                                 content=json.dumps(value))
+                for key, value in values.iteritems()]
+    yield storage.GetBackend().PutMultiAsync(entities)
+    for entity in entities:
+      _cache.Set(entity.key.id(), entity.content)
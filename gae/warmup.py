@@ -0,0 +1,25 @@
+import importlib
+import logging
+import time
+import webapp2
+from push_messaging import PushMessagingService
+from stats import Stats
+import storage
+
+# Handler modules of the routes clients and Drive wait on, see handler.py.
+_LATENCY_SENSITIVE_MODULES = ['notify_handlers', 'client_handlers']
+
+# GET /_ah/warmup
+# Sent by App Engine to a new instance before it gets traffic. Loads the
+# handlers of latency sensitive routes, which also compiles the request
+# validators, and primes the storage backend and the push access token.
+class WarmupHandler(webapp2.RequestHandler):
+  def get(self):
+    start = time.time()
+    for name in _LATENCY_SENSITIVE_MODULES:
+      importlib.import_module(name)
+    storage.GetBackend()
+    if not PushMessagingService().WarmUp():
+      logging.warning('Warmup: No push messaging access token.')
+    Stats.Record('warmup', time.time() - start)
+    self.response.status = 200
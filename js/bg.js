@@ -168,7 +168,13 @@ chrome.app.runtime.onLaunched.addListener(wrapListener(function(launchData) {
 }));
 
 chrome.alarms.onAlarm.addListener(wrapListener(function(alarm) {
-  if (!engine || !engine.isIdle()) 
+  if (!engine)
+    return;
+  if (alarm.name == CHANNEL_RENEW_ALARM_NAME) {
+    engine.replacePushChannel();
+    return;
+  }
+  if (!engine.isIdle())
     return;
   if (alarm.name == SCAN_LOCAL_ALARM_NAME)
     engine.scanFiles({local: true});
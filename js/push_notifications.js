@@ -9,6 +9,8 @@
     '/bind';
 /** @const */ var PUSH_NOTIFICATION_STATUS_URL = PUSH_NOTIFICATION_SERVER +
     '/status';
+/** @const */ var PUSH_NOTIFICATION_OUTBOX_URL = PUSH_NOTIFICATION_SERVER +
+    '/outbox';
 /** @const */ var PUSH_MESSAGING_SUB_CHANNEL = 0;
 /** @const */ var CHANNEL_OVERLAP_TIME = 1000 * 60 * 5;
 /** @const */ var CHANNEL_RENEW_ALARM_NAME = 'pushRenew';
@@ -25,9 +27,20 @@ log.registerSource('PushNotificationHandler');
 function PushNotificationHandler(drive) {
   this.requestSender_ = new RequestSender();
   this.drive_ = drive;
+  this.changeListener_ = null;
   return this;
 }
 
+/**
+ * Set the listener of change notifications.
+ * @param {function(Object)} listener Called with largestChangeId,
+ *     firstChangeId and notificationCount of the changes the client hasn't
+ *     fetched since it last bound the channel.
+ */
+PushNotificationHandler.prototype.setChangeListener = function(listener) {
+  this.changeListener_ = listener;
+};
+
 /**
  * chrome.pushMessaging.onMessage handler.
  * @param {Object} message
@@ -35,6 +48,24 @@ function PushNotificationHandler(drive) {
 PushNotificationHandler.prototype.onMessage = function(message) {
   if (message.subchannelId == PUSH_MESSAGING_SUB_CHANNEL) {
     console.log('PUSH: ', message);
+    var payload;
+    try {
+      payload = JSON.parse(message.payload);
+    } catch (e) {
+      log.PushNotificationHandler.warn('Invalid push message.', message);
+      return;
+    }
+    // The server asks for a new channel before the current one expires. The
+    // alarm replaces the channel, see bind().
+    if (payload.renew)
+      chrome.alarms.create(CHANNEL_RENEW_ALARM_NAME, {when: Date.now()});
+    else if (payload.largestChangeId && this.changeListener_) {
+      this.changeListener_({
+        largestChangeId: parseInt(payload.largestChangeId),
+        firstChangeId: parseInt(payload.firstChangeId) || null,
+        notificationCount: payload.notificationCount || 1,
+      });
+    }
   } else {
     log.PushNotificationHandler.warn(
         'Received a message from an unknown subchannel.', message);
@@ -46,8 +77,11 @@ PushNotificationHandler.prototype.onMessage = function(message) {
  * @param {string} largestChangeId Largest change id known by the client.
  *     Notifications with smaller ids will be ignored.
  * @param {function} callback
+ * @param {boolean=} opt_replace Whether to establish a new channel that
+ *     replaces the current one even if it hasn't expired yet.
  */
-PushNotificationHandler.prototype.bind = function(largestChangeId, callback) {
+PushNotificationHandler.prototype.bind = function(largestChangeId, callback,
+    opt_replace) {
   chrome.storage.local.get([
     storageKeys.settings.clientId,
     storageKeys.pushNotifications.channelId,
@@ -64,10 +98,10 @@ PushNotificationHandler.prototype.bind = function(largestChangeId, callback) {
       return;
     }
 
-    if (this.isChannelAlive_(expiration))
+    if (!opt_replace && this.isChannelAlive_(expiration))
       this.renewChannel_(channelId, largestChangeId, callback);
     else
-      this.establishChannel_(clientId, largestChangeId, callback);
+      this.establishChannel_(clientId, channelId, largestChangeId, callback);
   }.bind(this));
 };
 
@@ -88,11 +122,13 @@ PushNotificationHandler.prototype.isChannelExpired = function(expiration) {
 /**
  * Establish a new channel.
  * @param {string} clientId The client ID.
+ * @param {?string} channelId The channel being replaced, if any. The new
+ *     channel keeps its relay state.
  * @param {string} largestChangeId
  * @param {function} callback
  */
 PushNotificationHandler.prototype.establishChannel_ = function(clientId,
-    largestChangeId, callback) {
+    channelId, largestChangeId, callback) {
   chrome.pushMessaging.getChannelId(false, function(details) {
     if (details && details.channelId) {
       this.drive_.setProperty(CHANNEL_ID_PROPERTY_FILE_ID,
@@ -107,7 +143,8 @@ PushNotificationHandler.prototype.establishChannel_ = function(clientId,
               callback(null, {tokenError: chrome.runtime.lastError});
               return;
             }
-            this.sendBindRequest_(clientId, largestChangeId, token, callback);
+            this.sendBindRequest_(clientId, channelId, largestChangeId, token,
+                callback);
           }.bind(this));
         }
       }.bind(this));
@@ -116,12 +153,16 @@ PushNotificationHandler.prototype.establishChannel_ = function(clientId,
   }.bind(this));
 };
 
-PushNotificationHandler.prototype.sendBindRequest_ = function(clientId, largestChangeId, token, callback) {
+PushNotificationHandler.prototype.sendBindRequest_ = function(clientId,
+    channelId, largestChangeId, token, callback) {
+  var body = {
+    clientId: clientId,
+    largestChangeId: largestChangeId,
+  };
+  if (channelId)
+    body.channelId = channelId;
   this.requestSender_.sendRequest('POST', PUSH_NOTIFICATION_BIND_URL, {
-    body: {
-      clientId: clientId,
-      largestChangeId: largestChangeId,
-    },
+    body: body,
     authorization: 'Bearer ' + token,
   }, function(xhr, error) {
     if (error)
@@ -166,3 +207,43 @@ PushNotificationHandler.prototype.renewChannel_ = function(channelId,
       callback(channelId);
   });
 };
+
+/**
+ * Fetch the change notifications the server kept for the channel while the
+ * client wasn't acknowledging them, e.g. when it was offline.
+ * @param {string} largestChangeId Largest change id known by the client.
+ * @param {function(Object)} callback Called with changes, a list of {id,
+ *     time} after |largestChangeId|, and complete, which is false if some
+ *     were dropped. Called with null if there's no channel or on error.
+ */
+PushNotificationHandler.prototype.fetchOutbox = function(largestChangeId,
+    callback) {
+  chrome.storage.local.get(storageKeys.pushNotifications.channelId,
+      function(items) {
+    var channelId = items[storageKeys.pushNotifications.channelId];
+    if (!channelId) {
+      callback(null);
+      return;
+    }
+    this.requestSender_.sendRequest('POST', PUSH_NOTIFICATION_OUTBOX_URL, {
+      body: {
+        channelId: channelId,
+        largestChangeId: largestChangeId,
+      },
+    }, function(xhr, error) {
+      if (error || xhr.status != 200) {
+        callback(null);
+        return;
+      }
+      var outbox;
+      try {
+        outbox = JSON.parse(xhr.responseText);
+      } catch (e) {
+        callback(null);
+        return;
+      }
+      callback(outbox);
+    });
+  }.bind(this));
+};
+
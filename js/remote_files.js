@@ -145,9 +145,27 @@ RemoteFileManager.prototype.scan_ = function(callback) {
   }.bind(this));
 };
 
+/**
+ * Set the number of changes the next fetch is expected to return, so that it
+ * needs as few pages as possible. The hint only raises the page size above
+ * the preferred one, since a smaller page saves nothing when there are fewer
+ * changes but costs extra requests when the count is an underestimate.
+ * @param {number} count
+ */
+RemoteFileManager.prototype.setChangesPageSizeHint = function(count) {
+  this.changesPageSizeHint_ = Math.max(
+      this.drive_.DRIVE_API_PREFERRED_PAGE_SIZE,
+      Math.min(count, this.drive_.DRIVE_API_MAX_RESULTS - 1));
+};
+
 RemoteFileManager.prototype.fetchChanges_ = function(callback) {
-  this.drive_.getChanges({startChangeId: parseInt(this.largestChangeId) + 1,
-      includeSubscribed: false}, function(changes, error) {
+  var options = {startChangeId: parseInt(this.largestChangeId) + 1,
+      includeSubscribed: false};
+  if (this.changesPageSizeHint_) {
+    options.pageSize = this.changesPageSizeHint_;
+    this.changesPageSizeHint_ = null;
+  }
+  this.drive_.getChanges(options, function(changes, error) {
     if (changes) {
       this.largestChangeId = changes.largestChangeId;
       callback(changes.items);
@@ -6,7 +6,9 @@ function SyncEngine(localRootEntry) {
   this.idle_ = true;
   this.local_ = new LocalFileManager(localRootEntry);
   this.remote_ = new RemoteFileManager();
-  this.pushNotificationHandler = new PushNotificationHandler();
+  this.pushNotificationHandler = new PushNotificationHandler(new GoogleDrive());
+  this.pushNotificationHandler.setChangeListener(
+      this.onRemoteChanges_.bind(this));
   this.tasks_ = new TaskQueue();
   this.tasks_.setMaxParallelTasks('upload', 2);
   this.tasks_.setMaxParallelTasks('download', 2);
@@ -21,9 +23,53 @@ SyncEngine.prototype.init = function(callback) {
     var error = errors[0] || errors[1];
     if (error)
       callback(error);
-    else
+    else {
+      this.resume_();
       callback();
-  });
+    }
+  }.bind(this));
+};
+
+/**
+ * Catch up with the remote changes missed while the client was offline. The
+ * server's outbox tells which changes were missed, so that the client only
+ * scans for changes when there are any.
+ */
+SyncEngine.prototype.resume_ = function() {
+  var largestChangeId = this.remote_.largestChangeId;
+  if (!largestChangeId)
+    return;
+  this.pushNotificationHandler.fetchOutbox(largestChangeId,
+      function(outbox) {
+    if (!outbox || !outbox.complete) {
+      if (this.isIdle())
+        this.scanFiles({remote: true});
+      return;
+    }
+    if (!outbox.changes.length)
+      return;
+    this.onRemoteChanges_({
+      largestChangeId: parseInt(outbox.changes[outbox.changes.length - 1].id),
+      firstChangeId: parseInt(outbox.changes[0].id),
+      notificationCount: outbox.changes.length,
+    });
+  }.bind(this));
+};
+
+/**
+ * Replace the push notification channel, either before it expires or when
+ * the server asks for it. The new channel takes over the relay state of the
+ * current one.
+ */
+SyncEngine.prototype.replacePushChannel = function() {
+  var largestChangeId = this.remote_.largestChangeId;
+  if (!largestChangeId)
+    return;
+  this.pushNotificationHandler.bind(String(largestChangeId),
+      function(channelId, error) {
+    if (!channelId)
+      log.SyncEngine.warn('Failed to replace the push channel.', error);
+  }, true);
 };
 
 SyncEngine.prototype.fetchChanges = function(callback) {
@@ -373,6 +419,29 @@ SyncEngine.prototype.getLocalTitle = function(remoteId) {
 SyncEngine.prototype.scanFiles = function(areas) {
 };
 
+/**
+ * Called when the server relays Drive changes. Changes the client has
+ * already fetched are ignored. Change ids are sparse, so the gap between the
+ * known and the largest change id only bounds the number of changes. When the
+ * client has fetched everything up to the relayed range, the changes left
+ * are the ones announced by the notificationCount notifications, one each
+ * unless the server coalesced them, so the next fetch asks for that many.
+ * @param {Object} range largestChangeId, firstChangeId and notificationCount.
+ */
+SyncEngine.prototype.onRemoteChanges_ = function(range) {
+  var known = parseInt(this.remote_.largestChangeId);
+  if (known >= range.largestChangeId) {
+    log.SyncEngine.info('Ignoring changes already fetched.', range);
+    return;
+  }
+  var count = range.largestChangeId - known;
+  if (known == range.firstChangeId - 1)
+    count = Math.min(count, range.notificationCount);
+  this.remote_.setChangesPageSizeHint(count);
+  if (this.isIdle())
+    this.scanFiles({remote: true});
+};
+
 SyncEngine.prototype.isIdle = function() {
   return this.idle_;
 };